@@ -0,0 +1,265 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from gbif_utils import (
+    GBIF_COLUMNS,
+    extend_columns,
+    occurences_csv,
+    occurrence_record_batch,
+    parse_occurence_columns,
+    request_occurencies,
+    trim_strings,
+)
+
+BASIS_OF_RECORD = ["HUMAN_OBSERVATION", "PRESERVED_SPECIMEN", "MACHINE_OBSERVATION"]
+LICENSES = [
+    "http://creativecommons.org/licenses/by/4.0/legalcode",
+    "http://creativecommons.org/licenses/by-nc/4.0/legalcode",
+    "http://creativecommons.org/publicdomain/zero/1.0/legalcode",
+]
+
+
+def legacy_parse(results):
+    """dict per record, the way parse_occurence_results worked before the
+    columnar parser (including the media check that never set mediaType)"""
+    parsed_results = []
+    for res in results:
+        event_date = res.get("eventDate")
+        try:
+            datetime.datetime.fromisoformat(event_date)
+        except:
+            print("invalid date", event_date)
+            continue
+        has_media = len(res.get("media")) > 0
+        media = json.dumps(res.get("media")) if has_media else None
+        mediaType = None
+        if has_media:
+            types = []
+            if isinstance(media, list):
+                for m in media:
+                    if "type" in m:
+                        types.append(m.get("type"))
+                mediaType = ",".join(list(set(types)))
+        parsed_results.append(
+            dict(
+                key=res.get("key"),
+                eventDate=event_date,
+                decimalLatitude=res.get("decimalLatitude"),
+                decimalLongitude=res.get("decimalLongitude"),
+                taxonKey=res.get("taxonKey"),
+                kingdomKey=res.get("kingdomKey"),
+                phylumKey=res.get("phylumKey"),
+                classKey=res.get("classKey"),
+                orderKey=res.get("orderKey"),
+                familyKey=res.get("familyKey"),
+                genusKey=res.get("genusKey"),
+                speciesKey=res.get("speciesKey"),
+                references=res.get("references"),
+                gbifReference=f"https://www.gbif.org/occurrence/{res.get('key')}",
+                datasetKey=res.get("datasetKey"),
+                datasetName=None,
+                datasetReference=f"https://www.gbif.org/dataset/{res.get('datasetKey')}",
+                license=res.get("license"),
+                basisOfRecord=res.get("basisOfRecord"),
+                mediaType=mediaType,
+                media=media,
+            )
+        )
+    return parsed_results
+
+
+def csv_field(value):
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+def legacy_csv(records):
+    """COPY csv of parsed records, the way occurences_csv wrote it per record"""
+    return "".join(
+        ",".join(csv_field(record.get(c)) for c in GBIF_COLUMNS) + "\n"
+        for record in records
+    )
+
+
+def synthetic_result(rng, key):
+    """occurrence search result with the fields the parser reads, padded
+    with other fields like a real result"""
+    day = datetime.date(2000, 1, 1) + datetime.timedelta(days=rng.randrange(8000))
+    event_date = rng.choice(
+        [
+            day.isoformat(),
+            f"{day.isoformat()}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00",
+            f"{day.isoformat()}T10:00",
+            f"{day.year}-{day.month:02d}",
+            f"{day.isoformat()}/{(day + datetime.timedelta(days=2)).isoformat()}",
+        ]
+        if rng.random() < 0.05
+        else [f"{day.isoformat()}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00"]
+    )
+    media = []
+    if rng.random() < 0.3:
+        media = [
+            dict(
+                type=rng.choice(["StillImage", "Sound"]),
+                format="image/jpeg",
+                identifier=f"https://inaturalist-open-data.s3.amazonaws.com/photos/{key}/{i}.jpg",
+                license=rng.choice(LICENSES),
+                rightsHolder="someone",
+            )
+            for i in range(rng.randrange(1, 4))
+        ]
+    result = dict(
+        key=key,
+        datasetKey=f"50c9509d-22c7-4a22-a47d-8c48425ef4{rng.randrange(100):02d}",
+        publishingOrgKey="28eb1a3f-1c15-4a95-931a-4af90ecb574d",
+        eventDate=event_date,
+        decimalLatitude=47.5 + rng.random(),
+        decimalLongitude=7.5 + rng.random(),
+        taxonKey=rng.randrange(10**7),
+        kingdomKey=1,
+        phylumKey=44,
+        classKey=212,
+        orderKey=rng.randrange(1000),
+        familyKey=rng.randrange(10**4),
+        genusKey=rng.randrange(10**6),
+        speciesKey=rng.randrange(10**7),
+        references=f"https://www.inaturalist.org/observations/{key}"
+        + ("?" + "x" * 300 if rng.random() < 0.01 else ""),
+        license=rng.choice(LICENSES),
+        basisOfRecord=rng.choice(BASIS_OF_RECORD),
+        media=media,
+    )
+    for i in range(60):
+        result[f"field{i}"] = f"value {i} of {key}"
+    return result
+
+
+def synthetic_pages(n_pages, limit, seed=0):
+    rng = random.Random(seed)
+    return [
+        [synthetic_result(rng, page * limit + i) for i in range(limit)]
+        for page in range(n_pages)
+    ]
+
+
+def read_pages(path):
+    with open(path) as f:
+        return [json.loads(line)["results"] for line in f]
+
+
+def measured(fn, *args):
+    """seconds of fn and peak traced bytes of a second run, tracing would
+    slow down the timed one. Printed warnings are dropped"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        fn(*args)
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def legacy_batches(pages, batch_size):
+    """parse, trim and encode pages in batches like occurrence_batches did
+    with records"""
+    batch = []
+    for page in pages:
+        batch += legacy_parse(page)
+        if len(batch) >= batch_size:
+            legacy_csv([trim_strings(r) for r in batch])
+            batch = []
+    legacy_csv([trim_strings(r) for r in batch])
+
+
+def column_batches(pages, batch_size):
+    batch = None
+    for page in pages:
+        columns = parse_occurence_columns(page)
+        batch = columns if batch is None else extend_columns(batch, columns)
+        if len(batch["key"]) >= batch_size:
+            occurences_csv(occurrence_record_batch(batch))
+            batch = None
+    if batch is not None:
+        occurences_csv(occurrence_record_batch(batch))
+
+
+def benchmark_parse(args):
+    if args.pages is None:
+        pages = synthetic_pages(args.n_pages, args.limit)
+    else:
+        pages = read_pages(args.pages)
+    n_results = sum(len(page) for page in pages)
+    print(f"{len(pages)} pages, {n_results} results")
+
+    paths = {}
+    for name, fn in [("records", legacy_batches), ("columns", column_batches)]:
+        seconds, peak = measured(fn, pages, args.batch_size)
+        paths[name] = (seconds, peak)
+        print(
+            f"{name:10}{seconds:>8.2f}s{n_results / seconds:>12.0f} results/s"
+            f"{peak / 2**20:>10.1f} MB peak"
+        )
+    print(f"speedup {paths['records'][0] / paths['columns'][0]:.1f}x")
+
+    # both paths agree, except for mediaType that the legacy path never set
+    for page in pages[: args.check_pages]:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            expected = [trim_strings(r) for r in legacy_parse(page)]
+            parsed = occurrence_record_batch(parse_occurence_columns(page)).to_pylist()
+        assert len(parsed) == len(expected)
+        for a, b in zip(parsed, expected):
+            assert {k: v for k, v in a.items() if k != "mediaType"} == {
+                k: v for k, v in b.items() if k != "mediaType"
+            }
+            assert (a["media"] is None) == (a["mediaType"] is None)
+
+
+def record_pages(args):
+    """save occurrence search responses of a query as json lines"""
+    with open(args.output, "w") as f:
+        for page in range(args.n_pages):
+            resp = request_occurencies(
+                args.taxon_key,
+                page * args.limit,
+                args.limit,
+                country=args.country,
+                media_type=args.media_type,
+            )
+            if resp is None:
+                break
+            f.write(json.dumps(resp) + "\n")
+            if resp.get("endOfRecords"):
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    parse = subparsers.add_parser("parse")
+    parse.add_argument("--pages", help="recorded pages, synthetic if omitted")
+    parse.add_argument("--n-pages", type=int, default=500)
+    parse.add_argument("--limit", type=int, default=300)
+    parse.add_argument("--batch-size", type=int, default=5000)
+    parse.add_argument("--check-pages", type=int, default=20)
+    parse.set_defaults(run=benchmark_parse)
+    record = subparsers.add_parser("record")
+    record.add_argument("-o", "--output", required=True)
+    record.add_argument("--taxon-key", type=int, default=212)
+    record.add_argument("--country", default="CH")
+    record.add_argument("--media-type", choices=["StillImage", "Sound"])
+    record.add_argument("--n-pages", type=int, default=50)
+    record.add_argument("--limit", type=int, default=300)
+    record.set_defaults(run=record_pages)
+    args = parser.parse_args()
+    args.run(args)
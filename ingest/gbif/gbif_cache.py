@@ -0,0 +1,111 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+DEFAULT_PATH = Path(__file__).with_name("gbif_cache.sqlite")
+DAY = 24 * 3600
+# sqlite limits the number of parameters of a statement
+BATCH_SIZE = 500
+
+
+class GbifCache:
+    """persistent cache of GBIF API results in SQLite, keyed by namespace
+    (e.g. "species"), key and language. Entries older than ttl seconds, or
+    negative_ttl seconds for cached 404s (stored as None), count as missing"""
+
+    def __init__(self, path=DEFAULT_PATH, ttl=90 * DAY, negative_ttl=7 * DAY):
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS gbif_cache (
+                namespace TEXT, key TEXT, language TEXT, value TEXT, fetched_at REAL,
+                PRIMARY KEY (namespace, key, language)
+            )"""
+        )
+        self.conn.commit()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = Counter()
+        self.misses = Counter()
+        self.lock = threading.Lock()
+
+    def get_many(self, namespace, keys, languages=("",)):
+        """fresh entries of the keys in all languages as {(key, language): value},
+        one query per BATCH_SIZE keys"""
+        keys = list(dict.fromkeys(str(k) for k in keys))
+        now = time.time()
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), BATCH_SIZE):
+                batch = keys[start : start + BATCH_SIZE]
+                rows = self.conn.execute(
+                    f"""SELECT key, language, value, fetched_at FROM gbif_cache
+                        WHERE namespace = ? AND key IN ({",".join("?" * len(batch))})""",
+                    [namespace] + batch,
+                )
+                for key, language, value, fetched_at in rows:
+                    ttl = self.ttl if value is not None else self.negative_ttl
+                    if language in languages and now - fetched_at < ttl:
+                        found[(key, language)] = json.loads(value) if value else None
+            hits = len(found)
+            self.hits[namespace] += hits
+            self.misses[namespace] += len(keys) * len(languages) - hits
+        return found
+
+    def put_many(self, namespace, entries):
+        """store (key, language, value) entries, value None caches a 404"""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                """INSERT OR REPLACE INTO gbif_cache VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (
+                        namespace,
+                        str(key),
+                        language,
+                        None if value is None else json.dumps(value),
+                        now,
+                    )
+                    for key, language, value in entries
+                ],
+            )
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                namespace: dict(
+                    hits=self.hits[namespace],
+                    misses=self.misses[namespace],
+                    hit_ratio=self.hits[namespace]
+                    / max(1, self.hits[namespace] + self.misses[namespace]),
+                )
+                for namespace in set(self.hits) | set(self.misses)
+            }
+
+    def close(self):
+        self.conn.close()
+
+
+cache = None
+
+
+def configure_cache(path=DEFAULT_PATH, **kwargs):
+    """replace the shared cache, e.g. to change its ttl"""
+    global cache
+    if cache is not None:
+        cache.close()
+    cache = GbifCache(path, **kwargs)
+    return cache
+
+
+def get_cache():
+    if cache is None:
+        configure_cache()
+    return cache
+
+
+def cache_stats():
+    return {} if cache is None else cache.stats()
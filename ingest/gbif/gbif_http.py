@@ -0,0 +1,263 @@
+import asyncio
+import email.utils
+import functools
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# upper bound of concurrent requests, the AdaptiveLimiter starts lower and
+# finds the actual limit
+DEFAULT_WORKERS = 32
+RETRY_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self):
+        return dict(
+            requests=self.requests,
+            retries=self.retries,
+            errors=self.errors,
+            mean_latency=self.seconds / self.requests if self.requests else None,
+            max_latency=self.max_seconds,
+        )
+
+
+def retry_after_seconds(value):
+    """Retry-After header in seconds or as HTTP date"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class AdaptiveLimiter:
+    """AIMD limit of concurrent requests. The limit grows by one per round
+    of successful responses whose latency stays within latency_tolerance
+    times the fastest recent latency of their endpoint, slower responses
+    keep it. Throttling (429, 503) and errors multiply it by
+    decrease_factor, once per round: responses to requests started before
+    the last decrease do not decrease it again"""
+
+    def __init__(
+        self,
+        max_limit=DEFAULT_WORKERS,
+        initial_limit=4,
+        min_limit=1,
+        latency_tolerance=2.0,
+        decrease_factor=0.5,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(initial_limit, max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline = {}
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.throttled = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """wait for a free slot, returns the start time for release"""
+        with self.condition:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, endpoint, started, status=None):
+        """status None for connection errors"""
+        seconds = time.monotonic() - started
+        with self.condition:
+            self.in_flight -= 1
+            if status is None or status in RETRY_STATUS:
+                if status in THROTTLE_STATUS:
+                    self.throttled += 1
+                else:
+                    self.errors += 1
+                if started >= self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = time.monotonic()
+                    self.decreases += 1
+            else:
+                # the baseline follows the fastest latency, but forgets it
+                # slowly, e.g. if the API got slower for everyone
+                baseline = self.baseline.get(endpoint, seconds)
+                baseline = min(seconds, baseline + 0.01 * (seconds - baseline))
+                self.baseline[endpoint] = baseline
+                if seconds <= self.latency_tolerance * baseline:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def cancel(self):
+        """free a slot without adapting the limit"""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                limit=int(self.limit),
+                max_limit=self.max_limit,
+                in_flight=self.in_flight,
+                waiting=self.waiting,
+                decreases=self.decreases,
+                throttled=self.throttled,
+                errors=self.errors,
+            )
+
+
+class GbifSession:
+    """keep-alive connection pool for the GBIF API. Throttled (429) and failed
+    (5xx, connection errors) requests are retried with exponential backoff and
+    full jitter, a Retry-After header of the response is honoured. The
+    number of requests at once is adapted by an AdaptiveLimiter of at most
+    pool_size. Requests, retries and latency are counted per endpoint"""
+
+    def __init__(
+        self,
+        pool_size=DEFAULT_WORKERS,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=60.0,
+        timeout=30.0,
+        initial_limit=4,
+    ):
+        self.session = requests.Session()
+        # pool_block makes threads beyond pool_size wait for a connection
+        # instead of opening throwaway ones
+        adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.limiter = AdaptiveLimiter(pool_size, initial_limit)
+        self.stats = defaultdict(EndpointStats)
+        self.lock = threading.Lock()
+
+    def backoff_seconds(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+    def record(self, endpoint, seconds, retry=False, error=False):
+        with self.lock:
+            stats = self.stats[endpoint]
+            stats.requests += 1
+            stats.retries += retry
+            stats.errors += error
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def get(self, url, endpoint, headers=None, params=None):
+        """returns the last response, which may still be an error after
+        max_retries, connection errors are raised after max_retries"""
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(
+                    url, headers=headers, params=params, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.release(endpoint, started)
+                self.record(endpoint, time.perf_counter() - start, attempt > 0, True)
+                if last_attempt:
+                    raise
+                time.sleep(self.backoff_seconds(attempt))
+                continue
+            except BaseException:
+                self.limiter.cancel()
+                raise
+            self.limiter.release(endpoint, started, resp.status_code)
+            error = resp.status_code in RETRY_STATUS
+            self.record(endpoint, time.perf_counter() - start, attempt > 0, error)
+            if not error or last_attempt:
+                return resp
+            retry_after = retry_after_seconds(resp.headers.get("Retry-After"))
+            resp.close()
+            time.sleep(self.backoff_seconds(attempt, retry_after))
+
+    def stats_dict(self):
+        with self.lock:
+            return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def close(self):
+        self.session.close()
+
+
+session = GbifSession()
+# runs the requests of the coroutines of all event loops, its size is the
+# global limit of concurrent async requests
+executor = ThreadPoolExecutor(DEFAULT_WORKERS)
+
+
+def configure_session(pool_size=DEFAULT_WORKERS, **kwargs):
+    """replace the shared session and request executor, pool_size is the
+    upper bound of the adaptive request limit"""
+    global session, executor
+    session.close()
+    executor.shutdown(wait=False)
+    session = GbifSession(pool_size, **kwargs)
+    executor = ThreadPoolExecutor(pool_size)
+    return session
+
+
+def http_get(url, endpoint, headers=None, params=None):
+    return session.get(url, endpoint, headers=headers, params=params)
+
+
+def map_requests(fn, items):
+    """fn over items on the request executor, returns the results as list"""
+    return list(executor.map(fn, items))
+
+
+def submit_request(fn, *args):
+    """fn(*args) on the request executor, returns a future"""
+    return executor.submit(fn, *args)
+
+
+async def http_get_async(url, endpoint, headers=None, params=None):
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(http_get, url, endpoint, headers, params)
+    )
+
+
+def request_stats():
+    return session.stats_dict()
+
+
+def concurrency_stats():
+    """current request limit, requests in flight and waiting for a slot"""
+    return session.limiter.stats()
@@ -1,8 +1,18 @@
-import requests
+import asyncio
 import json
+import requests
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 from concurrent.futures import ThreadPoolExecutor
 import datetime
+from collections import Counter, deque
+from io import BytesIO
+from psycopg2.extras import execute_values
+
+from gbif_cache import get_cache
+from gbif_http import http_get, http_get_async, map_requests, submit_request
 
 GBIF_MEDIA_TYPES = ["InteractiveResource", "MovingImage", "Sound", "StillImage"]
 
@@ -33,23 +43,26 @@ def trim_strings(record):
     return record
 
 
-def get_species_info(species_key):
-    headers = {"Accept-Language": "de-CH,de-DE;q=0.9,de;q=0.8,en-US;q=0.7,en;q=0.6"}
+SPECIES_LANGUAGES = {
+    "": None,
+    "de": {"Accept-Language": "de-CH,de-DE;q=0.9,de;q=0.8,en-US;q=0.7,en;q=0.6"},
+}
 
-    if species_key is None:
-        return None
+
+def request_species(species_key, language):
+    """(species_key, language, status, json), status None on connection errors"""
     sp_url = "https://api.gbif.org/v1/species/{}".format(species_key)
-    resp = requests.get(sp_url)
+    try:
+        resp = http_get(sp_url, "species", headers=SPECIES_LANGUAGES[language])
+    except requests.RequestException as e:
+        print("exc!", e)
+        return species_key, language, None, None
     if resp.status_code == 200:
-        resp = resp.json()
-    else:
-        return None
+        return species_key, language, 200, resp.json()
+    return species_key, language, resp.status_code, None
 
-    resp_de = requests.get(sp_url, headers=headers)
-    if resp_de.status_code == 200:
-        resp_de = resp_de.json()
-    else:
-        return None
+
+def species_info(species_key, resp, resp_de):
     return dict(
         species_key=species_key,
         kingdom_key=resp.get("kingdomKey"),
@@ -70,84 +83,277 @@ def get_species_info(species_key):
     )
 
 
-def get_dataset_name(dataset_key):
+def get_species_infos(species_keys, cache=None):
+    """{species_key: info or None} of many species. The responses are looked
+    up in the persistent cache in batches, only missing or expired ones are
+    requested, concurrently. 404s are cached as well, other errors are not"""
+    cache = cache or get_cache()
+    species_keys = [k for k in dict.fromkeys(species_keys) if k is not None]
+    languages = tuple(SPECIES_LANGUAGES)
+    responses = cache.get_many("species", species_keys, languages)
+    missing = [
+        (k, language)
+        for k in species_keys
+        for language in languages
+        if (str(k), language) not in responses
+    ]
+    fetched = map_requests(lambda args: request_species(*args), missing)
+    cache.put_many(
+        "species",
+        [(k, language, value) for k, language, status, value in fetched if status in (200, 404)],
+    )
+    for k, language, _, value in fetched:
+        responses[(str(k), language)] = value
+    infos = {}
+    for k in species_keys:
+        resp = responses.get((str(k), ""))
+        resp_de = responses.get((str(k), "de"))
+        if resp is None or resp_de is None:
+            infos[k] = None
+        else:
+            infos[k] = species_info(k, resp, resp_de)
+    return infos
+
+
+def get_species_info(species_key):
+    if species_key is None:
+        return None
+    return get_species_infos([species_key]).get(species_key)
+
+
+def request_dataset(dataset_key):
+    """(dataset_key, status, {"title": ...}), status None on connection errors"""
     url = f"https://api.gbif.org/v1/dataset/{dataset_key}"
-    res = requests.get(url)
+    try:
+        res = http_get(url, "dataset")
+    except requests.RequestException as e:
+        print("exc!", e)
+        return dataset_key, None, None
     if res.status_code == 200:
         try:
-            return res.json().get("title")
-        except:
-            return None
-    return None
+            return dataset_key, 200, dict(title=res.json().get("title"))
+        except ValueError:
+            return dataset_key, None, None
+    return dataset_key, res.status_code, None
+
+
+class DatasetNames:
+    """dataset titles by dataset key. Keys passed to add are looked up in the
+    persistent cache at once, unknown ones are requested in the background
+    on the shared request executor, so titles resolve while occurrences are
+    still being fetched"""
+
+    def __init__(self, cache=None):
+        self.cache = cache or get_cache()
+        self.names = {}
+        self.pending = {}
+
+    def add(self, dataset_keys):
+        new_keys = [
+            k
+            for k in set(dataset_keys)
+            if k is not None and k not in self.names and k not in self.pending
+        ]
+        if len(new_keys) == 0:
+            return
+        cached = self.cache.get_many("dataset", new_keys)
+        for k in new_keys:
+            if (str(k), "") in cached:
+                dataset = cached[(str(k), "")]
+                self.names[k] = None if dataset is None else dataset.get("title")
+            else:
+                self.pending[k] = submit_request(request_dataset, k)
+
+    def resolve(self):
+        """wait for the pending requests and store their results"""
+        fetched = [future.result() for future in self.pending.values()]
+        self.pending = {}
+        self.cache.put_many(
+            "dataset",
+            [(k, "", dataset) for k, status, dataset in fetched if status in (200, 404)],
+        )
+        for k, _, dataset in fetched:
+            self.names[k] = None if dataset is None else dataset.get("title")
+        return self.names
+
+    def get(self, dataset_key):
+        self.add([dataset_key])
+        return self.resolve().get(dataset_key)
+
+    def fill(self, occ: list):
+        """set datasetName of the records"""
+        self.add(o.get("datasetKey") for o in occ)
+        names = self.resolve()
+        for o in occ:
+            o["datasetName"] = names.get(o.get("datasetKey"))
+        return occ
+
+    def fill_columns(self, columns):
+        """set the datasetName column of parsed columns"""
+        self.add(columns["datasetKey"])
+        names = self.resolve()
+        columns["datasetName"] = [names.get(k) for k in columns["datasetKey"]]
+        return columns
+
+
+def get_dataset_name(dataset_key):
+    return DatasetNames().get(dataset_key)
+
+
+# columns of public.gbif
+GBIF_SCHEMA = pa.schema(
+    [
+        ("key", pa.int64()),
+        ("eventDate", pa.string()),
+        ("decimalLongitude", pa.float64()),
+        ("decimalLatitude", pa.float64()),
+        ("taxonKey", pa.int64()),
+        ("kingdomKey", pa.int64()),
+        ("phylumKey", pa.int64()),
+        ("classKey", pa.int64()),
+        ("orderKey", pa.int64()),
+        ("familyKey", pa.int64()),
+        ("genusKey", pa.int64()),
+        ("speciesKey", pa.int64()),
+        ("references", pa.string()),
+        ("gbifReference", pa.string()),
+        ("datasetKey", pa.string()),
+        ("datasetName", pa.string()),
+        ("datasetReference", pa.string()),
+        ("license", pa.string()),
+        ("basisOfRecord", pa.string()),
+        ("mediaType", pa.string()),
+        ("media", pa.string()),
+    ]
+)
+GBIF_COLUMNS = GBIF_SCHEMA.names
+
+# columns copied as is from the fields of an occurrence search result
+OCCURRENCE_FIELDS = {
+    "key": "key",
+    "eventDate": "eventDate",
+    "decimalLongitude": "decimalLongitude",
+    "decimalLatitude": "decimalLatitude",
+    "taxonKey": "taxonKey",
+    "kingdomKey": "kingdomKey",
+    "phylumKey": "phylumKey",
+    "classKey": "classKey",
+    "orderKey": "orderKey",
+    "familyKey": "familyKey",
+    "genusKey": "genusKey",
+    "speciesKey": "speciesKey",
+    "references": "references",
+    "datasetKey": "datasetKey",
+    "license": "license",
+    "basisOfRecord": "basisOfRecord",
+}
+# text columns cut to 254 characters like trim_strings, media is kept whole
+TRIMMED_COLUMNS = [
+    "eventDate",
+    "references",
+    "gbifReference",
+    "datasetName",
+    "datasetReference",
+    "license",
+    "basisOfRecord",
+    "mediaType",
+]
+# a single date or timestamp, not a range (2022-05-01/2022-05-03) or a
+# partial date (2022-05)
+ISO_DATE = (
+    r"\d{4}-\d{2}-\d{2}"
+    r"(?:[T ](?:[01]\d|2[0-3])(?::[0-5]\d(?::[0-5]\d(?:\.\d{1,6})?)?)?"
+    r"(?:Z|[+-]\d{2}:?\d{2})?)?"
+)
+
+
+def valid_event_dates(dates):
+    """boolean array, True for the dates matching ISO_DATE on an existing day"""
+    dates = pa.array([d if isinstance(d, str) else None for d in dates], pa.string())
+    day = pc.utf8_slice_codeunits(dates, 0, 10)
+    # strptime rolls 2022-02-30 over to March, formatting it again catches that
+    parsed = pc.strptime(day, format="%Y-%m-%d", unit="s", error_is_null=True)
+    valid = pc.and_(
+        pc.match_substring_regex(dates, f"^{ISO_DATE}$"),
+        pc.equal(pc.strftime(parsed, format="%Y-%m-%d"), day),
+    )
+    return pc.fill_null(valid, False).to_numpy(zero_copy_only=False)
+
+
+def media_types(media):
+    if not isinstance(media, list):
+        return None
+    types = {m.get("type") for m in media if isinstance(m, dict)}
+    types.discard(None)
+    return ",".join(sorted(types)) or None
+
+
+def parse_occurence_columns(results):
+    """{column: list} of the GBIF_COLUMNS of a page of occurrence search
+    results, records without a valid eventDate are dropped. datasetName is
+    left empty"""
+    dates = [r.get("eventDate") for r in results]
+    valid = valid_event_dates(dates)
+    if not valid.all():
+        print("invalid dates", [d for d, ok in zip(dates, valid) if not ok])
+        results = [r for r, ok in zip(results, valid) if ok]
+    columns = {c: [r.get(f) for r in results] for c, f in OCCURRENCE_FIELDS.items()}
+    media = [r.get("media") or None for r in results]
+    columns["media"] = [None if m is None else json.dumps(m) for m in media]
+    columns["mediaType"] = [media_types(m) for m in media]
+    columns["gbifReference"] = [
+        f"https://www.gbif.org/occurrence/{k}" for k in columns["key"]
+    ]
+    columns["datasetReference"] = [
+        f"https://www.gbif.org/dataset/{k}" for k in columns["datasetKey"]
+    ]
+    columns["datasetName"] = [None] * len(results)
+    return {c: columns[c] for c in GBIF_COLUMNS}
+
+
+def trim_text(array):
+    """strings longer than 254 characters cut like trim_strings"""
+    lengths = pc.utf8_length(array)
+    if not pc.any(pc.greater(lengths, 254)).as_py():
+        return array
+    trimmed = pc.binary_join_element_wise(pc.utf8_slice_codeunits(array, 0, 250), " ...", "")
+    return pc.if_else(pc.greater(lengths, 254), trimmed, array)
+
+
+def extend_columns(columns, more):
+    for c in GBIF_COLUMNS:
+        columns[c] += more[c]
+    return columns
+
+
+def column_records(columns):
+    return [dict(zip(GBIF_COLUMNS, row)) for row in zip(*(columns[c] for c in GBIF_COLUMNS))]
 
 
 def parse_occurence_results(results):
-    parsed_results = []
-    for res in results:
-        event_date = res.get("eventDate")
-        try:
-            date_valid = datetime.datetime.fromisoformat(event_date)
-        except:
-            print("invalid date", event_date)
-            continue
-
-        if event_date is not None:
-            has_media = len(res.get("media")) > 0
-            media = json.dumps(res.get("media")) if has_media else None
-            mediaType = None
-
-            if has_media:
-                types = []
-                if isinstance(media, list):
-                    for m in media:
-                        if "type" in m:
-                            types.append(m.get("type"))
-
-                    mediaType = ",".join(list(set(types)))
-
-            parsed_results.append(
-                dict(
-                    key=res.get("key"),
-                    eventDate=event_date,
-                    decimalLatitude=res.get("decimalLatitude"),
-                    decimalLongitude=res.get("decimalLongitude"),
-                    taxonKey=res.get("taxonKey"),
-                    kingdomKey=res.get("kingdomKey"),
-                    phylumKey=res.get("phylumKey"),
-                    classKey=res.get("classKey"),
-                    orderKey=res.get("orderKey"),
-                    familyKey=res.get("familyKey"),
-                    genusKey=res.get("genusKey"),
-                    speciesKey=res.get("speciesKey"),
-                    references=res.get("references"),
-                    gbifReference=f"https://www.gbif.org/occurrence/{res.get('key')}",
-                    datasetKey=res.get("datasetKey"),
-                    datasetName=None,
-                    datasetReference=f"https://www.gbif.org/dataset/{res.get('datasetKey')}",
-                    license=res.get("license"),
-                    basisOfRecord=res.get("basisOfRecord"),
-                    mediaType=mediaType,
-                    media=media,
-                )
-            )
-    return parsed_results
+    return column_records(parse_occurence_columns(results))
+
+
+def occurrence_record_batch(columns):
+    """arrow record batch of parsed columns with the TRIMMED_COLUMNS trimmed"""
+    arrays = [
+        pa.array(columns[field.name], field.type) for field in GBIF_SCHEMA
+    ]
+    for c in TRIMMED_COLUMNS:
+        i = GBIF_SCHEMA.get_field_index(c)
+        arrays[i] = trim_text(arrays[i])
+    return pa.RecordBatch.from_arrays(arrays, schema=GBIF_SCHEMA)
 
 
 def update_dataset_names(occ: list):
-    unique_dataset_keys = list(set([o.get("datasetKey") for o in occ]))
-    dk_dn_mapping = {dk: None for dk in unique_dataset_keys}
-    for dk in unique_dataset_keys:
-        dk_dn_mapping[dk] = get_dataset_name(dk)
-    for i in range(len(occ)):
-        occ[i]["datasetName"] = dk_dn_mapping[occ[i].get("datasetKey")]
-    return occ
+    return DatasetNames().fill(occ)
 
 
 def parse_species_keys_from_results(results, unique=True):
     species_keys = []
     for res in results:
         species_key = res.get("speciesKey")
-        if species_keys is not None:
+        if species_key is not None:
             species_keys.append(species_key)
 
     if unique:
@@ -156,7 +362,7 @@ def parse_species_keys_from_results(results, unique=True):
         return species_keys
 
 
-def request_occurencies(
+def occurrence_search_url(
     taxon_key,
     offset,
     limit,
@@ -168,8 +374,7 @@ def request_occurencies(
     gadm_gid=None,
     decimal_latitude=None,
     decimal_longitude=None,
-    parse=False,
-    key_only=False,
+    last_interpreted: tuple = None,
 ):
     if type(taxon_key) == list:
         taxon_key = ",".join(str(x) for x in taxon_key)
@@ -218,10 +423,17 @@ def request_occurencies(
             lon_min=lon_min, lon_max=lon_max
         )
 
+    if last_interpreted is not None:
+        assert type(last_interpreted) == tuple
+        url += "&lastInterpreted={start},{end}".format(
+            start=last_interpreted[0], end=last_interpreted[1]
+        )
+
     url += "&offset={offset}&limit={limit}".format(offset=offset, limit=limit)
+    return url
 
-    # print(url)
-    resp = requests.get(url)
+
+def parse_occurence_response(resp, parse=False, key_only=False):
     if resp.status_code == 200:
         try:
             resp_json = resp.json()
@@ -240,8 +452,10 @@ def request_occurencies(
     return None
 
 
-def get_number_of_occurencies(
+def request_occurencies(
     taxon_key,
+    offset,
+    limit,
     coordinates: tuple = None,
     radius_km=None,
     date_range: tuple = None,
@@ -250,63 +464,358 @@ def get_number_of_occurencies(
     gadm_gid=None,
     decimal_latitude=None,
     decimal_longitude=None,
+    parse=False,
+    key_only=False,
+    last_interpreted: tuple = None,
 ):
-    if type(taxon_key) == list:
-        taxon_key = ",".join(str(x) for x in taxon_key)
-    url = "https://api.gbif.org/v1/occurrence/search?taxonKey={taxon_key}".format(
-        taxon_key=taxon_key
+    url = occurrence_search_url(
+        taxon_key,
+        offset,
+        limit,
+        coordinates=coordinates,
+        radius_km=radius_km,
+        date_range=date_range,
+        country=country,
+        media_type=media_type,
+        gadm_gid=gadm_gid,
+        decimal_latitude=decimal_latitude,
+        decimal_longitude=decimal_longitude,
+        last_interpreted=last_interpreted,
     )
+    # print(url)
+    resp = http_get(url, "occurrence/search")
+    return parse_occurence_response(resp, parse, key_only)
 
-    if coordinates is not None and radius_km is not None:
-        assert type(coordinates) == tuple
-        url += "&geoDistance={center_lat},{center_lon},{dist_km}km".format(
-            center_lat=coordinates[0], center_lon=coordinates[1], dist_km=radius_km
-        )
-
-    if date_range is not None:
-        assert type(date_range) == tuple
 
-        if len(date_range) == 2:
-            date_range = date_range[0] + "," + date_range[1]
-        elif len(date_range) == 1:
-            date_range = date_range[0]
+async def request_occurencies_async(
+    taxon_key, offset, limit, parse=False, key_only=False, **filters
+):
+    url = occurrence_search_url(taxon_key, offset, limit, **filters)
+    resp = await http_get_async(url, "occurrence/search")
+    return parse_occurence_response(resp, parse, key_only)
 
-        url += "&eventDate={date_range}".format(date_range=date_range)
-    if country is not None:
-        url += "&country={country}".format(country=country)
 
-    if media_type is not None:
-        assert media_type in GBIF_MEDIA_TYPES
-        url += "&mediaType={media_type}".format(media_type=media_type)
+async def facet_counts_async(
+    taxon_key, field="speciesKey", facet_limit=1000, **filters
+):
+    """Counter {value: number of occurrences} of a facet field of the
+    occurrences matching the filters. Only the facets are requested
+    (limit=0), facet_limit values per request until a request returns fewer.
+    Values that look like ints (keys) are ints. Returns None if a request
+    failed"""
+    counts = Counter()
+    offset = 0
+    while True:
+        url = occurrence_search_url(taxon_key, 0, 0, **filters)
+        url += f"&facet={field}&facetLimit={facet_limit}&facetOffset={offset}"
+        resp = await http_get_async(url, "occurrence/search facet")
+        if resp.status_code != 200:
+            print("failed to request facets", field, filters)
+            return None
+        facets = resp.json().get("facets") or [dict(counts=[])]
+        values = facets[0].get("counts", [])
+        for value in values:
+            name = value.get("name")
+            counts[int(name) if name.lstrip("-").isdigit() else name] += value.get("count")
+        if len(values) < facet_limit:
+            return counts
+        offset += facet_limit
 
-    if gadm_gid is not None:
-        url += "&gadmGid={gadm_gid}".format(gadm_gid=gadm_gid)
 
-    if decimal_latitude is not None:
-        assert type(decimal_latitude) == tuple
-        lat_min = min(decimal_latitude)
-        lat_max = max(decimal_latitude)
-        url += "&decimalLatitude={lat_min},{lat_max}".format(
-            lat_min=lat_min, lat_max=lat_max
+def get_species_counts(
+    taxon_key,
+    coordinates: tuple = None,
+    radius_km=None,
+    date_range: tuple = None,
+    country=None,
+    media_type=None,
+    gadm_gid=None,
+    decimal_latitude=None,
+    decimal_longitude=None,
+    last_interpreted: tuple = None,
+    facet_limit=1000,
+):
+    """Counter {species_key: number of occurrences} from the speciesKey facet,
+    occurrences without species are not counted"""
+    return run_sync(
+        facet_counts_async(
+            taxon_key,
+            "speciesKey",
+            facet_limit,
+            coordinates=coordinates,
+            radius_km=radius_km,
+            date_range=date_range,
+            country=country,
+            media_type=media_type,
+            gadm_gid=gadm_gid,
+            decimal_latitude=decimal_latitude,
+            decimal_longitude=decimal_longitude,
+            last_interpreted=last_interpreted,
         )
+    )
 
-    if decimal_longitude is not None:
-        assert type(decimal_longitude) == tuple
-        lon_min = min(decimal_longitude)
-        lon_max = max(decimal_longitude)
-        url += "&decimalLongitude={lon_min},{lon_max}".format(
-            lon_min=lon_min, lon_max=lon_max
-        )
 
-    url += "&offset={offset}&limit={limit}".format(offset=0, limit=1)
+async def cell_species_counts(taxon_key, cells, facet_limit=1000, **filters):
+    """Counter {species_key: number of occurrences} of all cells, requested
+    concurrently. Raises IncompleteResults if a cell failed"""
+    counts = Counter()
+    for cell_counts in await asyncio.gather(
+        *[
+            facet_counts_async(
+                taxon_key,
+                "speciesKey",
+                facet_limit,
+                decimal_latitude=cell.get("lat"),
+                decimal_longitude=cell.get("lon"),
+                **filters,
+            )
+            for cell in cells
+        ]
+    ):
+        if cell_counts is None:
+            raise IncompleteResults(f"failed to request species facets {filters}")
+        counts.update(cell_counts)
+    return counts
 
-    # print(url)
-    resp = requests.get(url)
+
+def get_number_of_occurencies(
+    taxon_key,
+    coordinates: tuple = None,
+    radius_km=None,
+    date_range: tuple = None,
+    country=None,
+    media_type=None,
+    gadm_gid=None,
+    decimal_latitude=None,
+    decimal_longitude=None,
+    last_interpreted: tuple = None,
+):
+    url = occurrence_search_url(
+        taxon_key,
+        offset=0,
+        limit=1,
+        coordinates=coordinates,
+        radius_km=radius_km,
+        date_range=date_range,
+        country=country,
+        media_type=media_type,
+        gadm_gid=gadm_gid,
+        decimal_latitude=decimal_latitude,
+        decimal_longitude=decimal_longitude,
+        last_interpreted=last_interpreted,
+    )
+    resp = http_get(url, "occurrence/search")
     if resp.status_code == 200:
         return resp.json().get("count")
     return None
 
 
+class IncompleteResults(Exception):
+    pass
+
+
+async def occurrence_pages(
+    taxon_key,
+    total_limit=100000,
+    limit=100,
+    strict=False,
+    max_in_flight=16,
+    page_slots=None,
+    **filters,
+):
+    """yields the results of the occurrence search pages of one query as they
+    arrive. The first page gives the count, the remaining pages are requested
+    concurrently, at most max_in_flight at a time and bounded by the shared
+    request executor. page_slots, an asyncio.Semaphore shared by concurrent
+    queries, bounds the pages requested or waiting to be taken of all of them.
+    Failed pages are skipped, or raise IncompleteResults if strict"""
+    if page_slots is None:
+        page_slots = asyncio.Semaphore(max_in_flight)
+
+    async def request_page(offset):
+        # a page holds its slot until it is taken, failed pages give it back
+        await page_slots.acquire()
+        try:
+            resp = await request_occurencies_async(taxon_key, offset, limit, **filters)
+        except requests.RequestException as e:
+            # connection errors left after the retries of the session
+            print("exc!", e)
+            resp = None
+        except BaseException:
+            page_slots.release()
+            raise
+        if resp is None:
+            page_slots.release()
+        return resp
+
+    def holds_slot(page):
+        return (
+            page.done()
+            and not page.cancelled()
+            and page.exception() is None
+            and page.result() is not None
+        )
+
+    first = await request_page(0)
+    if first is None:
+        if strict:
+            raise IncompleteResults(f"failed to request occurrences {filters}")
+        print("failed to request occurrences", filters)
+        return
+    try:
+        yield first.get("results")
+    finally:
+        page_slots.release()
+    if first.get("endOfRecords") != False:
+        return
+    if strict and first.get("count") > total_limit:
+        raise IncompleteResults(f"more than {total_limit} occurrences {filters}")
+    end = min(first.get("count"), total_limit)
+    offsets = iter(range(limit, end, limit))
+    pending = set()
+
+    def request_more():
+        # new pages are only requested as fast as the consumer takes them
+        for offset in offsets:
+            pending.add(asyncio.ensure_future(request_page(offset)))
+            if len(pending) >= max_in_flight:
+                break
+
+    request_more()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # one page at a time, the others stay pending until they are taken
+            page = done.pop()
+            pending.discard(page)
+            request_more()
+            resp = page.result()
+            if resp is None:
+                if strict:
+                    raise IncompleteResults(f"failed to request a page {filters}")
+                print("failed to request an occurrence page", filters)
+                continue
+            try:
+                yield resp.get("results")
+            finally:
+                page_slots.release()
+    finally:
+        for page in pending:
+            if holds_slot(page):
+                page_slots.release()
+            page.cancel()
+
+
+async def cell_occurrence_pages(
+    taxon_key, cells, max_pending=100, max_in_flight=32, **filters
+):
+    """yields (cell index, results) of the occurrence pages of all cells
+    ({"lat": (min, max), "lon": (min, max)} as from get_grid_coordinates), all
+    cells are paged concurrently on one event loop and share its request limit.
+    At most max_in_flight pages of all cells are requested or waiting to be
+    queued and max_pending are queued, however many cells there are"""
+    queue = asyncio.Queue(max_pending)
+    page_slots = asyncio.Semaphore(max_in_flight)
+    done = object()
+
+    async def page_cell(i, cell):
+        async for results in occurrence_pages(
+            taxon_key,
+            page_slots=page_slots,
+            decimal_latitude=cell.get("lat"),
+            decimal_longitude=cell.get("lon"),
+            **filters,
+        ):
+            await queue.put((i, results))
+
+    async def page_cells():
+        tasks = [asyncio.ensure_future(page_cell(i, c)) for i, c in enumerate(cells)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # a failed or cancelled cell stops all cells, the queued pages
+            # are dropped so that the end never waits for a full queue
+            for task in tasks:
+                task.cancel()
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(done)
+            raise
+        await queue.put(done)
+
+    producer = asyncio.ensure_future(page_cells())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        await producer
+    finally:
+        producer.cancel()
+
+
+async def occurrence_batches(
+    taxon_key, cells, batch_size=5000, dataset_names=None, **filters
+):
+    """parsed occurrences of all cells as arrow record batches of batch_size
+    rows as the pages arrive, with dataset names and trimmed strings. The
+    titles of new datasets are requested as soon as a page brings them up"""
+    dataset_names = dataset_names or DatasetNames()
+    loop = asyncio.get_running_loop()
+
+    async def finish(batch):
+        batch = await loop.run_in_executor(None, dataset_names.fill_columns, batch)
+        return occurrence_record_batch(batch)
+
+    batch = None
+    async for _, page in cell_occurrence_pages(taxon_key, cells, **filters):
+        columns = parse_occurence_columns(page)
+        dataset_names.add(columns["datasetKey"])
+        batch = columns if batch is None else extend_columns(batch, columns)
+        if len(batch["key"]) >= batch_size:
+            yield await finish(batch)
+            batch = None
+    if batch is not None and len(batch["key"]) > 0:
+        yield await finish(batch)
+
+
+async def load_batches(batches, load, max_pending=2):
+    """load(batch) for every batch of the async iterable on one extra thread,
+    e.g. to insert and commit it with a database connection. At most
+    max_pending batches wait for loading, then fetching is held back.
+    Returns the results of load"""
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    results = []
+    with ThreadPoolExecutor(1) as executor:
+        async for batch in batches:
+            if len(pending) >= max_pending:
+                results.append(await pending.popleft())
+            pending.append(loop.run_in_executor(executor, load, batch))
+        while pending:
+            results.append(await pending.popleft())
+    return results
+
+
+def run_sync(coro):
+    """run a coroutine from sync code, also from a notebook whose event loop
+    is already running"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+async def collect_pages(pages, parse):
+    results = []
+    async for page in pages:
+        results += parse(page)
+    return results
+
+
 def get_species_keys_from_occurences(
     taxon_key,
     coordinates: tuple = None,
@@ -317,16 +826,31 @@ def get_species_keys_from_occurences(
     gadm_gid=None,
     decimal_latitude=None,
     decimal_longitude=None,
+    last_interpreted: tuple = None,
     total_limit=100000,
     unique=True,
+    facets=True,
 ):
-    species_keys = []
-    offset = 0
-    limit = 100
-    resp = request_occurencies(
+    """species keys of the occurrences, from the speciesKey facet if unique
+    and facets (a few requests, total_limit does not apply), otherwise from
+    all occurrence pages (one key per occurrence if not unique)"""
+    if unique and facets:
+        counts = get_species_counts(
+            taxon_key,
+            coordinates=coordinates,
+            radius_km=radius_km,
+            date_range=date_range,
+            country=country,
+            media_type=media_type,
+            gadm_gid=gadm_gid,
+            decimal_latitude=decimal_latitude,
+            decimal_longitude=decimal_longitude,
+            last_interpreted=last_interpreted,
+        )
+        return None if counts is None else list(counts)
+    pages = occurrence_pages(
         taxon_key,
-        offset=offset,
-        limit=limit,
+        total_limit=total_limit,
         coordinates=coordinates,
         radius_km=radius_km,
         date_range=date_range,
@@ -335,43 +859,15 @@ def get_species_keys_from_occurences(
         gadm_gid=gadm_gid,
         decimal_latitude=decimal_latitude,
         decimal_longitude=decimal_longitude,
+        last_interpreted=last_interpreted,
     )
-    species_keys += parse_species_keys_from_results(resp.get("results"), unique=unique)
-    eor = resp.get("endOfRecords")
-    if eor == False:
-        remaining_records = resp.get("count") - (limit + offset)
-        assert remaining_records < (total_limit - (limit + offset))
-
-        no_steps = int(round(remaining_records / limit + 0.5))
-        offset += limit
-        offsets = [offset + (limit * i) for i in range(no_steps)]
-        with ThreadPoolExecutor(max_workers=None) as executor:
-            thread_results = [
-                executor.submit(
-                    request_occurencies,
-                    taxon_key,
-                    offset=offset_t,
-                    limit=limit,
-                    coordinates=coordinates,
-                    radius_km=radius_km,
-                    date_range=date_range,
-                    country=country,
-                    media_type=media_type,
-                    gadm_gid=gadm_gid,
-                    decimal_latitude=decimal_latitude,
-                    decimal_longitude=decimal_longitude,
-                    parse=False,
-                    key_only=True,
-                )
-                for offset_t in offsets
-            ]
-        for future in thread_results:
-            if unique:
-                species_keys = list(set(species_keys + future.result()))
-
-            else:
-                species_keys += future.result()
-
+    species_keys = run_sync(
+        collect_pages(
+            pages, lambda page: parse_species_keys_from_results(page, unique=False)
+        )
+    )
+    if unique:
+        return list(set(species_keys))
     return species_keys
 
 
@@ -385,16 +881,12 @@ def get_occurences(
     gadm_gid=None,
     decimal_latitude=None,
     decimal_longitude=None,
+    last_interpreted: tuple = None,
     total_limit=100000,
 ):
-    parsed_results = []
-
-    offset = 0
-    limit = 100
-    resp = request_occurencies(
+    pages = occurrence_pages(
         taxon_key,
-        offset=offset,
-        limit=limit,
+        total_limit=total_limit,
         coordinates=coordinates,
         radius_km=radius_km,
         date_range=date_range,
@@ -403,40 +895,140 @@ def get_occurences(
         gadm_gid=gadm_gid,
         decimal_latitude=decimal_latitude,
         decimal_longitude=decimal_longitude,
+        last_interpreted=last_interpreted,
     )
-    parsed_results += parse_occurence_results(resp.get("results"))
+    return run_sync(collect_pages(pages, parse_occurence_results))
 
-    eor = resp.get("endOfRecords")
-    if eor == False:
-        remaining_records = min(
-            resp.get("count") - (limit + offset), total_limit - limit
-        )
 
-        no_steps = int(round(remaining_records / limit + 0.5))
-        offset = limit
-
-        offsets = [offset + (limit * i) for i in range(no_steps)]
-
-        with ThreadPoolExecutor(max_workers=None) as executor:
-            thread_results = [
-                executor.submit(
-                    request_occurencies,
-                    taxon_key,
-                    offset=offset_t,
-                    limit=limit,
-                    coordinates=coordinates,
-                    radius_km=radius_km,
-                    date_range=date_range,
-                    country=country,
-                    media_type=media_type,
-                    gadm_gid=gadm_gid,
-                    decimal_latitude=decimal_latitude,
-                    decimal_longitude=decimal_longitude,
-                    parse=True,
-                )
-                for offset_t in offsets
-            ]
-        for future in thread_results:
-            parsed_results += future.result()
+def occurences_csv(batch):
+    """COPY csv of an occurrence record batch, written by arrow. Strings are
+    always quoted and nulls are empty, so quotes, tabs and newlines in
+    references or the media json survive and an empty string stays distinct
+    from NULL"""
+    buffer = BytesIO()
+    pa_csv.write_csv(
+        batch,
+        buffer,
+        pa_csv.WriteOptions(include_header=False),
+    )
+    buffer.seek(0)
+    return buffer
+
+
+def load_occurences(batch, conn):
+    """load an occurrence record batch into public.gbif with COPY into a staging
+    table and one upsert, committed. Records that did not change are left
+    alone, records seen twice (on the border of two cells) are loaded once.
+    Returns the number of new and of updated rows"""
+    columns = [f'"{c.lower()}"' for c in GBIF_COLUMNS]
+    names = ", ".join(columns)
+    cur = conn.cursor()
+    # only the loaded columns, other columns of public.gbif keep their values
+    cur.execute(
+        f"""CREATE TEMP TABLE gbif_staging ON COMMIT DROP AS
+            SELECT {names} FROM public.gbif WITH NO DATA"""
+    )
+    cur.copy_expert(
+        f"COPY gbif_staging ({names}) FROM STDIN WITH (FORMAT csv)",
+        occurences_csv(batch),
+    )
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns[1:])
+    stored = ", ".join(f"g.{c}" for c in columns[1:])
+    loaded = ", ".join(f"EXCLUDED.{c}" for c in columns[1:])
+    cur.execute(
+        f"""INSERT INTO public.gbif AS g ({names})
+            SELECT DISTINCT ON ("key") {names} FROM gbif_staging ORDER BY "key"
+            ON CONFLICT ("key") DO UPDATE SET {updates}
+                WHERE ({stored}) IS DISTINCT FROM ({loaded})
+            RETURNING (xmax = 0)"""
+    )
+    new_rows = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    inserted = sum(new_rows)
+    return inserted, len(new_rows) - inserted
+
+
+REFRESH_STATE_DDL = """CREATE TABLE IF NOT EXISTS gbif_refresh_state (
+    scope text PRIMARY KEY, watermark timestamptz, full_at timestamptz
+)"""
+
 
-    return parsed_results
+def read_refresh_state(conn, scope):
+    """start time of the last successful refresh (watermark) and of the last
+    full reconciliation (full_at) of a scope, None before its first refresh"""
+    cur = conn.cursor()
+    cur.execute(REFRESH_STATE_DDL)
+    cur.execute(
+        "SELECT watermark, full_at FROM gbif_refresh_state WHERE scope = %s",
+        (scope,),
+    )
+    row = cur.fetchone()
+    conn.commit()
+    if row is None:
+        return None
+    return dict(watermark=row[0], full_at=row[1])
+
+
+def write_refresh_state(cur, scope, started_at, full):
+    """to be written only after every page of the refresh was loaded, the
+    occurrence batches are committed before it"""
+    cur.execute(
+        """INSERT INTO gbif_refresh_state (scope, watermark, full_at) VALUES (%s, %s, %s)
+            ON CONFLICT (scope) DO UPDATE SET watermark = EXCLUDED.watermark,
+                full_at = coalesce(EXCLUDED.full_at, gbif_refresh_state.full_at)""",
+        (scope, started_at, started_at if full else None),
+    )
+
+
+def last_interpreted_since(watermark, overlap=datetime.timedelta(days=1)):
+    """lastInterpreted range of an incremental refresh, the search only takes
+    dates, so a day of overlap covers records interpreted during the last run"""
+    return ((watermark - overlap).strftime("%Y-%m-%d"), "*")
+
+
+def period_bounds(date_range: tuple):
+    """[start, end) timestamps of a GBIF eventDate range like ("2022", "2023-05-01"),
+    the end includes the whole year, month or day"""
+    start = pd.Timestamp(date_range[0])
+    last = date_range[-1]
+    end = pd.Timestamp(last) + {
+        1: pd.DateOffset(years=1),
+        2: pd.DateOffset(months=1),
+        3: pd.DateOffset(days=1),
+    }[len(last.split("-"))]
+    return start.to_pydatetime(), end.to_pydatetime()
+
+
+def delete_missing_occurences(
+    cur, keys, taxon_key, decimal_latitude: tuple, decimal_longitude: tuple, date_range: tuple
+):
+    """full reconciliation: delete the occurrences of the taxon, box and date
+    range that were not returned by a complete download, keys are all
+    occurrence keys of the download. Returns the number of deleted rows"""
+    start, end = period_bounds(date_range)
+    cur.execute("CREATE TEMP TABLE gbif_current (key bigint PRIMARY KEY) ON COMMIT DROP")
+    execute_values(
+        cur,
+        "INSERT INTO gbif_current VALUES %s ON CONFLICT DO NOTHING",
+        [(k,) for k in keys],
+        page_size=10000,
+    )
+    cur.execute(
+        """DELETE FROM public.gbif g
+            WHERE %(taxon)s IN (g.taxonKey, g.kingdomKey, g.phylumKey, g.classKey,
+                    g.orderKey, g.familyKey, g.genusKey, g.speciesKey)
+                AND g.decimalLatitude BETWEEN %(lat_min)s AND %(lat_max)s
+                AND g.decimalLongitude BETWEEN %(lon_min)s AND %(lon_max)s
+                AND g.eventDate >= %(start)s AND g.eventDate < %(end)s
+                AND NOT EXISTS (SELECT 1 FROM gbif_current c WHERE c.key = g."key")""",
+        dict(
+            taxon=taxon_key,
+            lat_min=min(decimal_latitude),
+            lat_max=max(decimal_latitude),
+            lon_min=min(decimal_longitude),
+            lon_max=max(decimal_longitude),
+            start=start,
+            end=end,
+        ),
+    )
+    return cur.rowcount
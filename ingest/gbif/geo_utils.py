@@ -32,3 +32,63 @@ def get_grid_coordinates(lats, lons):
             lon_range = (lons[j - 1], lons[j])
             grid_coordinates.append(dict(lat=lat_range, lon=lon_range))
     return grid_coordinates
+
+
+def split_cell(cell):
+    """the four quadrants of a {"lat": (min, max), "lon": (min, max)} cell"""
+    lat_min, lat_max = cell["lat"]
+    lon_min, lon_max = cell["lon"]
+    lat_mid = (lat_min + lat_max) / 2
+    lon_mid = (lon_min + lon_max) / 2
+    return [
+        dict(lat=lat_range, lon=lon_range)
+        for lat_range in [(lat_min, lat_mid), (lat_mid, lat_max)]
+        for lon_range in [(lon_min, lon_mid), (lon_mid, lon_max)]
+    ]
+
+
+def plan_query_cells(
+    included_points,
+    count,
+    max_count=100000,
+    max_depth=10,
+    map_fn=map,
+    cells_per_axis=24,
+):
+    """adaptive quadtree over the bounding box of included_points: cells with
+    max_count or more occurrences are split into quadrants, empty cells are
+    dropped. count(lat_range, lon_range) returns the occurrences of a cell,
+    the cells of a level are counted with map_fn (e.g. an executor's map).
+    Returns the query cells (with their "count") and a report comparing the
+    count requests with a uniform cells_per_axis x cells_per_axis grid"""
+    lats, lons = get_lat_lon_cells(included_points, 1)
+    level = [dict(lat=(lats[0], lats[1]), lon=(lons[0], lons[1]))]
+    cells = []
+    count_requests = 0
+    depth = 0
+    while len(level) > 0:
+        counts = list(map_fn(lambda cell: count(cell["lat"], cell["lon"]), level))
+        count_requests += len(level)
+        next_level = []
+        for cell, n in zip(level, counts):
+            if n == 0:
+                continue
+            if n is None:
+                print("count failed, keeping cell", cell)
+            elif n >= max_count and depth < max_depth:
+                next_level += split_cell(cell)
+                continue
+            elif n >= max_count:
+                print("Too many Points!", cell, n)
+            cells.append(dict(cell, count=n))
+        level = next_level
+        depth += 1
+    uniform_requests = cells_per_axis**2
+    report = dict(
+        cells=len(cells),
+        depth=depth - 1,
+        count_requests=count_requests,
+        uniform_requests=uniform_requests,
+        saved_requests=uniform_requests - count_requests,
+    )
+    return cells, report
@@ -0,0 +1,379 @@
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import resource
+import subprocess
+import tempfile
+import time
+from io import StringIO
+from pathlib import Path
+
+from ingest_metrics import peak_rss_bytes
+from insert_from_zip import (
+    CSV_ENGINES,
+    csvStringIO_to_df,
+    encode_copy_payload,
+    ingest_data,
+    insert_legends,
+    iter_data_sections,
+    iter_text_chunks,
+    LOADERS,
+    melt_section,
+    open_archive,
+    parse_legend_file,
+    postgresql_connect,
+    read_section_typed,
+    section_dtypes,
+    sync_metadata,
+)
+from synthetic_idaweb import (
+    RESOLUTIONS,
+    section_text,
+    synthetic_section,
+    write_archive,
+)
+
+def legacy_records(df):
+    """per-row tuples, the way insert_data built them before melt_section"""
+    times = df.date.tolist()
+    stn_ids = df.stn.tolist()
+    records = []
+    for param in list(df.columns[3:]):
+        values = df[param].tolist()
+        param_id = [param for i in range(len(values))]
+        data = [(times[i], param, stn_ids[i], values[i]) for i in range(len(values))]
+        data = filter(lambda x: math.isnan(x[3]) == False, data)
+        records += list(data)
+    return records
+
+
+def legacy_payload(records):
+    buffer = StringIO()
+    for ts, param_id, stn_id, value in records:
+        buffer.write(f"{ts}\t{param_id}\t{stn_id}\t{value}\n")
+    buffer.seek(0)
+    return buffer
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_reshape(args):
+    n_rows = args.cells // args.params
+    df = synthetic_section(n_rows, args.params)
+    print(f"{n_rows} rows x {args.params} parameters = {n_rows * args.params} cells")
+
+    records, t_legacy_reshape = timed(legacy_records, df)
+    _, t_legacy_encode = timed(legacy_payload, records)
+    n_legacy = len(records)
+    del records
+
+    long_df, t_reshape = timed(melt_section, df)
+    _, t_encode = timed(encode_copy_payload, long_df)
+    assert len(long_df) == n_legacy
+
+    print(f"{'':10}{'reshape':>10}{'encode':>10}{'total':>10}")
+    for name, t_r, t_e in [
+        ("legacy", t_legacy_reshape, t_legacy_encode),
+        ("melt", t_reshape, t_encode),
+    ]:
+        print(f"{name:10}{t_r:>9.2f}s{t_e:>9.2f}s{t_r + t_e:>9.2f}s")
+    print(
+        f"speedup: reshape {t_legacy_reshape / t_reshape:.1f}x, "
+        f"total {(t_legacy_reshape + t_legacy_encode) / (t_reshape + t_encode):.1f}x"
+    )
+
+
+def benchmark_parse(args):
+    readers = {
+        "pandas": lambda text, dtypes: csvStringIO_to_df(StringIO(text)),
+        "typed": lambda text, dtypes: read_section_typed(StringIO(text), dtypes),
+        "pyarrow": lambda text, dtypes: read_section_typed(
+            StringIO(text), dtypes, "pyarrow"
+        ),
+    }
+    print(f"{'':10}" + "".join(f"{name:>12}" for name in readers))
+    for resolution, freq in RESOLUTIONS.items():
+        df = synthetic_section(
+            args.rows, args.params, freq=freq, n_stations=args.stations
+        )
+        text = section_text(df)
+        dtypes = section_dtypes(df.columns[3:])
+        size_mb = len(text.encode()) / 2**20
+        throughput = []
+        for read in readers.values():
+            _, seconds = timed(read, text, dtypes)
+            throughput.append(size_mb / seconds)
+        print(f"{resolution:10}" + "".join(f"{t:>7.1f} MB/s" for t in throughput))
+
+
+class StandInCursor:
+    """in-process stand-in for a database cursor: COPY payloads are read
+    completely and all rows are reported as skipped"""
+
+    def __init__(self):
+        self.rowcount = 0
+
+    def execute(self, query, args=None):
+        pass
+
+    def copy_expert(self, sql, file):
+        file.read()
+
+
+class StandInConnection:
+    def cursor(self):
+        return StandInCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class StandInSink:
+    """ingest_data sink that encodes the records like the copy loader and
+    drops them"""
+
+    name = "stand-in"
+
+    def sync_metadata(self, df_station, df_param):
+        pass
+
+    def watermarks(self, station_ids):
+        return {}
+
+    def committed_units(self, archive_sha256):
+        return []
+
+    def load(self, records, units=None):
+        encode_copy_payload(records)
+        return 0, len(records)
+
+    def close(self):
+        pass
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_stages(args):
+    """time every stage of the ingest of one archive sequentially, the load
+    stage includes the encoding done by the loader"""
+    if args.archive is None:
+        archive_path = Path(tempfile.mkdtemp()) / "synthetic.zip"
+        write_archive(
+            archive_path,
+            n_stations=args.stations,
+            n_params=args.params,
+            resolution=args.resolution,
+            start=args.start,
+            end=args.end,
+        )
+    else:
+        archive_path = Path(args.archive)
+    if args.credentials is not None:
+        conn = postgresql_connect(args.credentials)
+    elif args.loader == "copy":
+        conn = StandInConnection()
+    else:
+        raise SystemExit("the values loader needs a database (-c)")
+
+    stages = {
+        stage: dict(seconds=0.0, rows=0, bytes=0)
+        for stage in ["legend", "split", "parse", "reshape", "encode", "load"]
+    }
+
+    def record(stage, seconds, rows=0, size=0):
+        stages[stage]["seconds"] += seconds
+        stages[stage]["rows"] += rows
+        stages[stage]["bytes"] += size
+
+    archive, legend_files, data_files = open_archive(archive_path)
+    param_ids = []
+    for legend_file in legend_files:
+        (df_station, df_param), seconds = timed(parse_legend_file, archive, legend_file)
+        record("legend", seconds, len(df_station) + len(df_param))
+        if args.credentials is not None:
+            sync_metadata(df_station, df_param, conn)
+        param_ids += df_param["param_id"].tolist()
+    dtypes = section_dtypes(param_ids)
+    load = LOADERS[args.loader]
+
+    for data_file in data_files:
+        for section in iter_data_sections(archive, data_file):
+            chunks = iter_text_chunks(section, args.chunksize)
+            while True:
+                text, seconds = timed(next, chunks, None)
+                if text is None:
+                    break
+                record("split", seconds, text.count("\n") - 1, len(text))
+                if args.csv_engine == "pandas":
+                    df, seconds = timed(csvStringIO_to_df, StringIO(text))
+                else:
+                    df, seconds = timed(
+                        read_section_typed, StringIO(text), dtypes, args.csv_engine
+                    )
+                record("parse", seconds, len(df), len(text))
+                records, seconds = timed(melt_section, df)
+                record("reshape", seconds, len(records))
+                payload, seconds = timed(encode_copy_payload, records)
+                record("encode", seconds, len(records), payload.getbuffer().nbytes)
+                (inserted, skipped), seconds = timed(load, records, conn)
+                record("load", seconds, inserted + skipped)
+
+    for stage in stages.values():
+        stage["rows_per_second"] = stage["rows"] / stage["seconds"] if stage["seconds"] else None
+        stage["mb_per_second"] = (
+            stage["bytes"] / 2**20 / stage["seconds"] if stage["seconds"] and stage["bytes"] else None
+        )
+    results = dict(
+        commit=git_commit(),
+        timestamp=datetime.datetime.now().isoformat(timespec="seconds"),
+        archive=str(archive_path),
+        archive_bytes=archive_path.stat().st_size,
+        options=dict(
+            loader=args.loader,
+            csv_engine=args.csv_engine,
+            chunksize=args.chunksize,
+            database=args.credentials is not None,
+        ),
+        stages=stages,
+    )
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        Path(args.output).write_text(output)
+
+
+def measure_memory(archive_path, args, results):
+    """child process: peak RSS growth of ingest_data with a memory budget"""
+    baseline = peak_rss_bytes()
+    sink = StandInSink()
+    _, param_ids = insert_legends([archive_path], sink)
+    totals = ingest_data(
+        [archive_path],
+        sink,
+        args.workers,
+        args.load_workers,
+        args.chunksize,
+        dtypes=section_dtypes(param_ids),
+        memory_budget=args.memory_budget << 20,
+    )
+    results.put(
+        dict(
+            rows=totals["skipped"],
+            main_growth=peak_rss_bytes() - baseline,
+            workers_peak=peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+def memory_runs(args):
+    """ingest one-station 10 minute sections of args.years length with a
+    memory budget, each in a fresh process"""
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for years in args.years:
+        # ru_maxrss survives exec, so the archive is written by another
+        # process to keep the peak of this one low
+        archive_path = Path(tempfile.mkdtemp()) / f"synthetic_{years}y.zip"
+        writer = context.Process(
+            target=write_archive,
+            args=(archive_path,),
+            kwargs=dict(
+                n_stations=1,
+                n_params=args.params,
+                resolution="10min",
+                start="1990-01-01",
+                end=f"{1989 + years}-12-31",
+            ),
+        )
+        writer.start()
+        writer.join()
+        results = context.Queue()
+        process = context.Process(
+            target=measure_memory, args=(archive_path, args, results)
+        )
+        process.start()
+        # the result is small, so the child can exit before it is read
+        process.join()
+        if writer.exitcode != 0 or process.exitcode != 0:
+            raise RuntimeError(f"ingest of {years} years failed")
+        run = results.get()
+        archive_path.unlink()
+        runs.append(run)
+        print(
+            f"{years:>3} years: {run['rows']:>10} rows, "
+            f"main +{run['main_growth'] / 2**20:.0f} MB, "
+            f"workers {run['workers_peak'] / 2**20:.0f} MB"
+        )
+    return runs
+
+
+def within_memory_budget(runs, memory_budget):
+    """the peak RSS growth of the main process stays within the budget (MB)
+    for every length and the peak of the workers does not grow with the
+    section length"""
+    ok = all(run["main_growth"] <= memory_budget << 20 for run in runs)
+    ok &= max(r["workers_peak"] for r in runs) <= 1.25 * min(
+        r["workers_peak"] for r in runs
+    )
+    return ok
+
+
+def benchmark_memory(args):
+    ok = within_memory_budget(memory_runs(args), args.memory_budget)
+    print(f"memory budget {args.memory_budget} MB: {'ok' if ok else 'EXCEEDED'}")
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    reshape = subparsers.add_parser("reshape")
+    reshape.add_argument("--cells", type=int, default=10_000_000)
+    reshape.add_argument("--params", type=int, default=10)
+    reshape.set_defaults(run=benchmark_reshape)
+    parse = subparsers.add_parser("parse")
+    parse.add_argument("--rows", type=int, default=1_000_000)
+    parse.add_argument("--params", type=int, default=5)
+    parse.add_argument("--stations", type=int, default=100)
+    parse.set_defaults(run=benchmark_parse)
+    stages = subparsers.add_parser("stages")
+    stages.add_argument("-a", "--archive", help="archive, generated if omitted")
+    stages.add_argument("-c", "--credentials", help="database, stand-in if omitted")
+    stages.add_argument("-o", "--output", help="json report, printed if omitted")
+    stages.add_argument("--loader", choices=LOADERS.keys(), default="copy")
+    stages.add_argument("--csv-engine", choices=CSV_ENGINES, default="typed")
+    stages.add_argument("--chunksize", type=int, default=200000)
+    stages.add_argument("--stations", type=int, default=4)
+    stages.add_argument("--params", type=int, default=5)
+    stages.add_argument("--resolution", choices=RESOLUTIONS.keys(), default="10min")
+    stages.add_argument("--start", default="2010-01-01")
+    stages.add_argument("--end", default="2019-12-31")
+    stages.set_defaults(run=benchmark_stages)
+    memory = subparsers.add_parser("memory")
+    memory.add_argument("--memory-budget", type=int, default=256, help="MB")
+    memory.add_argument("--years", type=int, nargs="+", default=[5, 30])
+    memory.add_argument("--params", type=int, default=5)
+    memory.add_argument("--workers", type=int, default=2)
+    memory.add_argument("--load-workers", type=int, default=2)
+    memory.add_argument("--chunksize", type=int, default=10**9)
+    memory.set_defaults(run=benchmark_memory)
+    args = parser.parse_args()
+    args.run(args)
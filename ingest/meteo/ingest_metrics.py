@@ -0,0 +1,185 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import psycopg2.extensions
+
+
+class StageStats:
+    def __init__(self):
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.calls = 0
+
+    def add(self, seconds, rows=0, size=0):
+        self.seconds += seconds
+        self.rows += rows
+        self.bytes += size
+        self.calls += 1
+
+    def to_dict(self):
+        return dict(
+            seconds=self.seconds, rows=self.rows, bytes=self.bytes, calls=self.calls
+        )
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """peak resident set size, ru_maxrss is in bytes on macOS and kB elsewhere"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class IngestMetrics:
+    """thread-safe collection of wall time, rows and bytes per stage and per
+    section, plus database round trips"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = defaultdict(StageStats)
+        self.sections = defaultdict(lambda: defaultdict(StageStats))
+        self.round_trips = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, rows=0, size=0, section=None):
+        with self.lock:
+            self.stages[stage].add(seconds, rows, size)
+            if section is not None:
+                self.sections[section][stage].add(seconds, rows, size)
+
+    @contextmanager
+    def timer(self, stage, rows=0, size=0, section=None):
+        start = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - start, rows, size, section)
+
+    def timed_iter(self, iterable, stage, section=None, rows=None, size=None):
+        """yields from iterable and records the time spent in next()"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(
+                stage,
+                time.perf_counter() - start,
+                rows(item) if rows else 0,
+                size(item) if size else 0,
+                section,
+            )
+            yield item
+
+    def round_trip(self, kind):
+        with self.lock:
+            self.round_trips[kind] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return dict(
+                duration_seconds=time.perf_counter() - self.started,
+                peak_rss_bytes=dict(
+                    main=peak_rss_bytes(),
+                    workers=peak_rss_bytes(resource.RUSAGE_CHILDREN),
+                ),
+                db_round_trips=dict(self.round_trips),
+                stages={k: v.to_dict() for k, v in self.stages.items()},
+                sections={
+                    section: {k: v.to_dict() for k, v in stages.items()}
+                    for section, stages in self.sections.items()
+                },
+            )
+
+    def to_prometheus(self, prefix="meteo_ingest"):
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{k}="{escape_label(v)}"' for k, v in labels.items()
+                )
+                if label_text:
+                    label_text = f"{{{label_text}}}"
+                lines.append(f"{prefix}_{name}{label_text} {value}")
+
+        metric(
+            "duration_seconds", "Wall time of the run", [({}, report["duration_seconds"])]
+        )
+        metric(
+            "peak_rss_bytes",
+            "Peak resident set size of the main process and the largest worker",
+            [({"process": k}, v) for k, v in report["peak_rss_bytes"].items()],
+        )
+        metric(
+            "db_round_trips",
+            "Database round trips by kind",
+            [({"kind": k}, v) for k, v in report["db_round_trips"].items()],
+        )
+        for field in ["seconds", "rows", "bytes", "calls"]:
+            metric(
+                f"stage_{field}",
+                f"{field.capitalize()} per ingest stage, summed over all chunks",
+                [({"stage": k}, v[field]) for k, v in report["stages"].items()],
+            )
+        for field in ["seconds", "rows"]:
+            metric(
+                f"section_{field}",
+                f"{field.capitalize()} per section and ingest stage",
+                [
+                    ({"section": section, "stage": stage}, v[field])
+                    for section, stages in report["sections"].items()
+                    for stage, v in stages.items()
+                ],
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """write a JSON report or, for .prom files, a Prometheus textfile.
+        The file is replaced atomically for the textfile collector"""
+        path = Path(path)
+        if path.suffix == ".prom":
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
+
+
+metrics = IngestMetrics()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        metrics.round_trip("execute")
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.round_trip("copy")
+        return super().copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """connection_factory counting statements, COPYs and commits"""
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        metrics.round_trip("commit")
+        return super().commit()
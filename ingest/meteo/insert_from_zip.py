@@ -4,12 +4,20 @@ import numpy as np
 import argparse
 import psycopg2
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from tqdm import tqdm
 from pathlib import Path
 import yaml
 import logging
-from io import TextIOWrapper, StringIO
-import math
+from io import TextIOWrapper, BytesIO, StringIO
+import struct
+import re
+import time
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ingest_metrics import metrics, CountingConnection
 
 logging.basicConfig(
     format="%(asctime)s.%(msecs)03d %(levelname)s : %(message)s",
@@ -18,20 +26,6 @@ logging.basicConfig(
 )
 
 
-def remove_whitespace(s):
-    while s.startswith(" "):
-        s = s[1:]
-    while s.endswith(" "):
-        s = s[:-1]
-    return s
-
-
-def remove_newline(s):
-    if s.endswith("\n"):
-        s = s[:-1]
-    return s
-
-
 def replace_semicolon(s):
     return s.replace("; ", ":")
 
@@ -63,8 +57,7 @@ def is_empty_line(line):
     return False
 
 
-def csvStringIO_to_df(csvStringIO):
-    df = pd.read_csv(csvStringIO, sep=";", low_memory=False)
+def format_section_df(df):
     for col in df.columns.tolist()[2:]:
         df[col] = pd.to_numeric(df[col], errors="coerce", downcast="float")
     format = "%Y%m%d"  # daily
@@ -77,224 +70,1021 @@ def csvStringIO_to_df(csvStringIO):
     return df
 
 
-def postgresql_connect(configuration_file):
+def csvStringIO_to_df(csvStringIO):
+    df = pd.read_csv(csvStringIO, sep=";", low_memory=False)
+    return format_section_df(df)
+
+
+CSV_ENGINES = ["typed", "pyarrow", "pandas"]
+
+
+def section_dtypes(param_ids):
+    """explicit dtypes of a data section for the parameters of the legends"""
+    dtypes = {"stn": "category", "time": "int64"}
+    dtypes.update({param_id: "float32" for param_id in param_ids})
+    return dtypes
+
+
+def decode_time(time):
+    """yyyymmdd[HH[MM]] integers to datetime64 without string parsing"""
+    time = np.asarray(time, dtype=np.int64)
+    hour = np.zeros_like(time)
+    minute = np.zeros_like(time)
+    if len(time) > 0 and time[0] >= 10**11:  # 10 minutes
+        minute = time % 100
+        time = time // 100
+    if len(time) > 0 and time[0] >= 10**9:  # hourly
+        hour = time % 100
+        time = time // 100
+    date = (time // 10000 - 1970).astype("datetime64[Y]") + (
+        time // 100 % 100 - 1
+    ).astype("timedelta64[M]")
+    return (
+        date.astype("datetime64[D]")
+        + (time % 100 - 1).astype("timedelta64[D]")
+        + hour.astype("timedelta64[h]")
+        + minute.astype("timedelta64[m]")
+    ).astype("datetime64[ns]")
+
+
+def read_section_typed(buffer, dtypes, engine="typed"):
+    """read a section with the explicit dtypes from section_dtypes, columns
+    that are not in the legends are converted like in format_section_df.
+    A value that is not a number is read as NaN like in format_section_df"""
+    try:
+        df = pd.read_csv(
+            buffer,
+            sep=";",
+            dtype=dtypes,
+            na_values=["-"],
+            engine="pyarrow" if engine == "pyarrow" else "c",
+        )
+    except ValueError:
+        # the parameter columns are read again without their dtypes and coerced
+        buffer.seek(0)
+        key_dtypes = {col: dtypes[col] for col in ["stn", "time"] if col in dtypes}
+        df = pd.read_csv(buffer, sep=";", dtype=key_dtypes, low_memory=False)
+        for col in df.columns.tolist()[2:]:
+            if col in dtypes:
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtypes[col])
+    for col in df.columns.tolist()[2:]:
+        if col not in dtypes:
+            df[col] = pd.to_numeric(df[col], errors="coerce", downcast="float")
+    df.insert(2, "date", decode_time(df["time"]))
+    return df
+
+
+def read_configuration(configuration_file):
     with open(configuration_file, "r") as stream:
         try:
             cfg = yaml.safe_load(stream)
         except yaml.YAMLError as exc:
             print(exc)
 
-    db_host = cfg.get("host")
-    db_port = int(cfg.get("port"))
-    db_user = cfg.get("user")
-    db_password = cfg.get("password")
-    database = cfg.get("database")
-    logging.info(f"Connecting to {db_host}:{db_port} / {database}")
+    return dict(
+        host=cfg.get("host"),
+        port=int(cfg.get("port")),
+        user=cfg.get("user"),
+        password=cfg.get("password"),
+        database=cfg.get("database"),
+    )
+
+
+def postgresql_connect(configuration_file):
+    db_params = read_configuration(configuration_file)
+    logging.info(
+        f"Connecting to {db_params['host']}:{db_params['port']} / {db_params['database']}"
+    )
     try:
-        conn = psycopg2.connect(
-            host=db_host,
-            port=db_port,
-            user=db_user,
-            password=db_password,
-            database=database,
-        )
+        conn = psycopg2.connect(connection_factory=CountingConnection, **db_params)
         return conn
     except Exception as e:
         print(e)
 
 
-def execute_query(query, args, conn):
+def postgresql_pool(configuration_file, maxconn):
+    db_params = read_configuration(configuration_file)
+    logging.info(
+        f"Connecting to {db_params['host']}:{db_params['port']} / {db_params['database']} with up to {maxconn} connections"
+    )
+    return ThreadedConnectionPool(
+        1, maxconn, connection_factory=CountingConnection, **db_params
+    )
+
+
+def upsert_rows(cur, query, rows, template):
+    """run an upsert with RETURNING (xmax = 0) for all rows in one statement,
+    returns the number of inserted and updated rows"""
+    if len(rows) == 0:
+        return 0, 0
+    result = execute_values(
+        cur, query, rows, template=template, page_size=len(rows), fetch=True
+    )
+    inserted = sum(1 for (is_insert,) in result if is_insert)
+    return inserted, len(result) - inserted
+
+
+def upsert_stations(df_station, cur):
+    """insert new stations and update changed ones,
+    returns (inserted, updated, unchanged)"""
+    query = """INSERT INTO station AS s (station_id, station_name, data_src, location, altitude)
+                VALUES %s ON CONFLICT (station_id) DO UPDATE SET
+                    station_name = EXCLUDED.station_name,
+                    data_src = EXCLUDED.data_src,
+                    location = EXCLUDED.location,
+                    altitude = EXCLUDED.altitude
+                WHERE (s.station_name, s.data_src, s.altitude)
+                        IS DISTINCT FROM (EXCLUDED.station_name, EXCLUDED.data_src, EXCLUDED.altitude)
+                    OR s.location IS NULL OR NOT s.location ~= EXCLUDED.location
+                RETURNING (xmax = 0)"""
+    df_station = df_station.drop_duplicates("stn_id", keep="last")
+    df_station = df_station[
+        ["stn_id", "stn_name", "data_src", "latitude", "longitude", "altitude"]
+    ]
+    df_station = df_station.astype(object).where(df_station.notna(), None)
+    rows = list(df_station.itertuples(index=False, name=None))
+    inserted, updated = upsert_rows(
+        cur, query, rows, template="(%s, %s, %s, point(%s, %s), %s)"
+    )
+    return inserted, updated, len(rows) - inserted - updated
+
+
+def upsert_parameters(df_param, cur):
+    """insert new parameters and update changed ones,
+    returns (inserted, updated, unchanged)"""
+    query = """INSERT INTO parameter AS p (param_id, unit, description) VALUES %s
+                ON CONFLICT (param_id) DO UPDATE SET
+                    unit = EXCLUDED.unit,
+                    description = EXCLUDED.description
+                WHERE (p.unit, p.description)
+                    IS DISTINCT FROM (EXCLUDED.unit, EXCLUDED.description)
+                RETURNING (xmax = 0)"""
+    df_param = df_param.drop_duplicates("param_id", keep="last")
+    rows = list(
+        df_param[["param_id", "unit", "description"]].itertuples(
+            index=False, name=None
+        )
+    )
+    inserted, updated = upsert_rows(cur, query, rows, template="(%s, %s, %s)")
+    return inserted, updated, len(rows) - inserted - updated
+
+
+def sync_metadata(df_station, df_param, conn):
+    """upsert stations and parameters in one transaction"""
     cur = conn.cursor()
-    if args:
-        cur.execute(query, args)
-    conn.commit()
-    conn.reset()
-
-
-def insert_stations(df_station, conn):
-    query = """INSERT INTO station (station_id, station_name, data_src, location, altitude) 
-                VALUES (%s, %s, %s, point(%s, %s), %s) ON CONFLICT DO NOTHING"""
-    for index, row in df_station.iterrows():
-        args = (
-            row["stn_id"],
-            row["stn_name"],
-            row["data_src"],
-            row["latitude"],
-            row["longitude"],
-            row["altitude"],
+    try:
+        stations = upsert_stations(df_station, cur)
+        parameters = upsert_parameters(df_param, cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for name, (inserted, updated, unchanged) in [
+        ("Stations", stations),
+        ("Parameters", parameters),
+    ]:
+        logging.info(
+            f"{name}: {inserted} inserted, {updated} updated, {unchanged} unchanged"
         )
-        execute_query(query=query, args=args, conn=conn)
+    return stations, parameters
 
 
-def insert_parameters(df_param, conn):
-    query = """INSERT INTO parameter (param_id, unit, description) VALUES (%s,%s,%s) ON CONFLICT DO NOTHING"""
-    for index, row in df_param.iterrows():
-        args = (row["param_id"], row["unit"], row["description"])
-        execute_query(query=query, args=args, conn=conn)
+VALUES_PAGE_SIZE = 16000
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\0" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
 
 
-def insert_data(df, conn):
+def melt_section(df):
+    """melt a section from wide (one column per parameter) to long format with
+    the meteodata column order (date, param, stn, value), NaNs are dropped"""
     param_ids = list(df.columns[3:])
-    times = df.date.tolist()
-    stn_ids = df.stn.tolist()
-    for param in tqdm(param_ids):
-        values = df[param].tolist()
-        param_id = [param for i in range(len(values))]
-        data = [(times[i], param, stn_ids[i], values[i]) for i in range(len(values))]
-        data = filter(lambda x: math.isnan(x[3]) == False, data)
-        data = list(data)
-        query = """INSERT INTO meteodata VALUES %s ON CONFLICT DO NOTHING"""
-        cur = conn.cursor()
-        execute_values(cur, query, data, page_size=16000)
-        conn.commit()
+    n = len(df)
+    values = df[param_ids].to_numpy(dtype=np.float32).T.ravel()
+    valid = ~np.isnan(values)
+    stn = pd.Categorical(df["stn"])
+    return pd.DataFrame(
+        {
+            "date": np.tile(df["date"].to_numpy(), len(param_ids))[valid],
+            "param": pd.Categorical.from_codes(
+                np.repeat(np.arange(len(param_ids), dtype=np.int16), n)[valid],
+                categories=param_ids,
+            ),
+            "stn": pd.Categorical.from_codes(
+                np.tile(stn.codes, len(param_ids))[valid],
+                categories=stn.categories,
+            ),
+            "value": values[valid],
+        }
+    )
+
+
+def encode_copy_payload(records):
+    """encode long format records as binary COPY payload for meteodata_staging.
+    Rows sharing a (param, stn) pair have a fixed width, so each group is
+    written as one numpy structured array"""
+    ts = (records["date"].to_numpy().astype("datetime64[us]") - PG_EPOCH).astype(
+        np.int64
+    )
+    values = records["value"].to_numpy(dtype=np.float32)
+    param = records["param"].cat
+    stn = records["stn"].cat
+    group = param.codes.astype(np.int64) * len(stn.categories) + stn.codes
+    order = np.argsort(group, kind="stable")
+    group = group[order]
+    bounds = np.flatnonzero(np.diff(group)) + 1
+    buffer = BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(group)]):
+        if start == end:
+            continue
+        rows = order[start:end]
+        param_id = str(param.categories[group[start] // len(stn.categories)]).encode()
+        stn_id = str(stn.categories[group[start] % len(stn.categories)]).encode()
+        block = np.empty(
+            len(rows),
+            dtype=[
+                ("fields", ">i2"),
+                ("ts_len", ">i4"),
+                ("ts", ">i8"),
+                ("param_len", ">i4"),
+                ("param", f"S{len(param_id)}"),
+                ("stn_len", ">i4"),
+                ("stn", f"S{len(stn_id)}"),
+                ("value_len", ">i4"),
+                ("value", ">f4"),
+            ],
+        )
+        block["fields"] = 4
+        block["ts_len"] = 8
+        block["ts"] = ts[rows]
+        block["param_len"] = len(param_id)
+        block["param"] = param_id
+        block["stn_len"] = len(stn_id)
+        block["stn"] = stn_id
+        block["value_len"] = 4
+        block["value"] = values[rows]
+        buffer.write(block.tobytes())
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+MANIFEST_DDL = """CREATE TABLE IF NOT EXISTS meteodata_ingest_manifest (
+    archive_sha256 text, data_file text, section integer, param_id text,
+    first_row integer, last_row integer, committed_at timestamptz DEFAULT now(),
+    PRIMARY KEY (archive_sha256, data_file, section, param_id, first_row, last_row)
+)"""
+
+
+ROLLUPS = {"meteodata_hourly": "hour", "meteodata_daily": "day"}
+ROLLUP_DDL = """CREATE TABLE IF NOT EXISTS {table} (
+    ts timestamp, param_id text, station_id text,
+    mean double precision, min real, max real, count integer,
+    PRIMARY KEY (ts, param_id, station_id)
+)"""
+
+
+def create_inserted_table(cur):
+    """rows inserted into meteodata by the current transaction"""
+    cur.execute(
+        """CREATE TEMP TABLE meteodata_inserted (
+            ts timestamp, param_id text, station_id text, value real
+        ) ON COMMIT DROP"""
+    )
+
+
+def update_rollups(cur):
+    """recompute the buckets of the rollup tables that the rows inserted by the
+    current transaction fall into from all rows of meteodata, other buckets
+    are not touched. The buckets are locked first (in key order), so the
+    recomputation also sees the rows of concurrent loads of the same bucket"""
+    for table, unit in ROLLUPS.items():
+        buckets = f"""SELECT DISTINCT date_trunc('{unit}', ts) AS ts, param_id, station_id
+            FROM meteodata_inserted"""
+        cur.execute(
+            f"""INSERT INTO {table} AS r (ts, param_id, station_id)
+                {buckets} ORDER BY 1, 2, 3
+                ON CONFLICT (ts, param_id, station_id) DO UPDATE SET count = r.count"""
+        )
+        cur.execute(
+            f"""INSERT INTO {table}
+                SELECT b.ts, b.param_id, b.station_id,
+                    avg(m.value), min(m.value), max(m.value), count(*)
+                FROM ({buckets}) b JOIN meteodata m
+                    ON m.ts >= b.ts AND m.ts < b.ts + interval '1 {unit}'
+                    AND m.param_id = b.param_id AND m.station_id = b.station_id
+                GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+                ON CONFLICT (ts, param_id, station_id) DO UPDATE SET
+                    mean = EXCLUDED.mean,
+                    min = EXCLUDED.min,
+                    max = EXCLUDED.max,
+                    count = EXCLUDED.count"""
+        )
+
+
+def record_units(cur, units):
+    """manifest rows (archive_sha256, data_file, section, param_id, first_row,
+    last_row) of the units loaded in the current transaction"""
+    if units:
+        execute_values(
+            cur,
+            """INSERT INTO meteodata_ingest_manifest
+                (archive_sha256, data_file, section, param_id, first_row, last_row)
+                VALUES %s ON CONFLICT DO NOTHING""",
+            units,
+        )
+
+
+def query_units(conn, archive_sha256):
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT data_file, section, param_id, first_row, last_row
+            FROM meteodata_ingest_manifest WHERE archive_sha256 = %s""",
+        (archive_sha256,),
+    )
+    return cur.fetchall()
+
+
+def load_values(records, conn, units=None):
+    """insert long format records with execute_values, returns (inserted, skipped)"""
+    query = """WITH inserted AS (
+            INSERT INTO meteodata VALUES %s ON CONFLICT DO NOTHING RETURNING *
+        ) INSERT INTO meteodata_inserted SELECT * FROM inserted"""
+    inserted = 0
+    cur = conn.cursor()
+    create_inserted_table(cur)
+    # the key order of load_copy, so concurrent loads lock rows in the same order
+    records = records.sort_values(
+        ["date", "param", "stn"],
+        key=lambda column: column.astype(str) if column.dtype == "category" else column,
+    )
+    for start in tqdm(range(0, len(records), VALUES_PAGE_SIZE)):
+        page = records.iloc[start : start + VALUES_PAGE_SIZE]
+        execute_values(
+            cur,
+            query,
+            page.itertuples(index=False, name=None),
+            page_size=VALUES_PAGE_SIZE,
+        )
+        inserted += cur.rowcount
+    update_rollups(cur)
+    record_units(cur, units)
+    conn.commit()
+    return inserted, len(records) - inserted
+
+
+def load_copy(records, conn, units=None):
+    """stream long format records into a staging table with COPY and merge them
+    into meteodata with a single upsert, returns (inserted, skipped).
+    The rollups and manifest units are updated in the same transaction"""
+    cur = conn.cursor()
+    cur.execute(
+        """CREATE TEMP TABLE meteodata_staging (
+            ts timestamp, param_id text, station_id text, value real
+        ) ON COMMIT DROP"""
+    )
+    create_inserted_table(cur)
+    start = time.perf_counter()
+    payload = encode_copy_payload(records)
+    metrics.record(
+        "encode", time.perf_counter() - start, len(records), payload.getbuffer().nbytes
+    )
+    cur.copy_expert("COPY meteodata_staging FROM STDIN WITH (FORMAT binary)", payload)
+    # a common key order keeps concurrent loads of overlapping archives from deadlocking
+    cur.execute(
+        """WITH inserted AS (
+            INSERT INTO meteodata SELECT * FROM meteodata_staging
+            ORDER BY ts, param_id, station_id ON CONFLICT DO NOTHING RETURNING *
+        ) INSERT INTO meteodata_inserted SELECT * FROM inserted"""
+    )
+    inserted = cur.rowcount
+    update_rollups(cur)
+    record_units(cur, units)
+    conn.commit()
+    return inserted, len(records) - inserted
+
+
+def insert_data(df, conn):
+    return load_values(melt_section(df), conn)
+
+
+LOADERS = {"copy": load_copy, "values": load_values}
+
+
+WATERMARKS = {}
+CSV_OPTIONS = dict(dtypes=None, engine="pandas")
+
+
+def init_parse_worker(watermarks, dtypes, csv_engine):
+    """process pool initializer"""
+    global WATERMARKS, CSV_OPTIONS
+    WATERMARKS = watermarks
+    CSV_OPTIONS = dict(dtypes=dtypes, engine=csv_engine)
+
+
+def query_watermarks(conn, station_ids):
+    """latest stored timestamp per (station, param) of the given stations"""
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT station_id, param_id, max(ts) FROM meteodata
+            WHERE station_id = ANY(%s) GROUP BY station_id, param_id""",
+        (list(station_ids),),
+    )
+    return {
+        (stn_id, param_id): pd.Timestamp(max_ts).to_datetime64()
+        for stn_id, param_id, max_ts in cur.fetchall()
+    }
+
+
+def prune_records(records, watermarks):
+    """drop records at or before the watermark of their (station, param),
+    returns (records, number of pruned records)"""
+    if not watermarks or len(records) == 0:
+        return records, 0
+    param = records["param"].cat
+    stn = records["stn"].cat
+    limits = np.full(
+        (len(param.categories), len(stn.categories)),
+        np.datetime64("NaT"),
+        dtype="datetime64[us]",
+    )
+    for i, param_id in enumerate(param.categories):
+        for j, stn_id in enumerate(stn.categories):
+            limits[i, j] = watermarks.get((stn_id, param_id), np.datetime64("NaT"))
+    limit = limits[param.codes, stn.codes]
+    keep = np.isnat(limit) | (records["date"].to_numpy() > limit)
+    return records[keep].reset_index(drop=True), int((~keep).sum())
+
+
+def parse_chunk(text, prune=True):
+    """process pool worker: csv chunk of a section to long format records,
+    with prune records older than the watermarks are dropped. Returns the
+    records, the number of pruned records and (stage, seconds, rows, bytes)
+    timings"""
+    start = time.perf_counter()
+    if CSV_OPTIONS["engine"] == "pandas" or CSV_OPTIONS["dtypes"] is None:
+        df = csvStringIO_to_df(StringIO(text))
+    else:
+        df = read_section_typed(
+            StringIO(text), CSV_OPTIONS["dtypes"], CSV_OPTIONS["engine"]
+        )
+    parsed = time.perf_counter()
+    records = melt_section(df)
+    melted = time.perf_counter()
+    pruned = 0
+    if prune:
+        records, pruned = prune_records(records, WATERMARKS)
+    timings = [
+        ("parse", parsed - start, len(df), len(text)),
+        ("reshape", melted - parsed, len(records) + pruned, 0),
+        ("prune", time.perf_counter() - melted, pruned, 0),
+    ]
+    return records, pruned, timings
+
+
+class DatabaseSink:
+    """loads records with one of the LOADERS over a pool of connections"""
+
+    def __init__(self, db_pool, loader):
+        self.db_pool = db_pool
+        self.name = loader
+        conn = self.db_pool.getconn()
+        try:
+            cur = conn.cursor()
+            cur.execute(MANIFEST_DDL)
+            for table in ROLLUPS:
+                cur.execute(ROLLUP_DDL.format(table=table))
+            conn.commit()
+        finally:
+            self.db_pool.putconn(conn)
+
+    def sync_metadata(self, df_station, df_param):
+        conn = self.db_pool.getconn()
+        try:
+            sync_metadata(df_station, df_param, conn)
+        finally:
+            self.db_pool.putconn(conn)
+
+    def watermarks(self, station_ids):
+        conn = self.db_pool.getconn()
+        try:
+            return query_watermarks(conn, station_ids)
+        finally:
+            conn.rollback()
+            self.db_pool.putconn(conn)
+
+    def committed_units(self, archive_sha256):
+        conn = self.db_pool.getconn()
+        try:
+            return query_units(conn, archive_sha256)
+        finally:
+            conn.rollback()
+            self.db_pool.putconn(conn)
+
+    def load(self, records, units=None):
+        """records and their manifest units are committed together"""
+        conn = self.db_pool.getconn()
+        try:
+            return LOADERS[self.name](records, conn, units)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    def close(self):
+        self.db_pool.closeall()
+
+
+def load_chunk(records, sink, section=None, units=None):
+    """load pool worker"""
+    start = time.perf_counter()
+    inserted, skipped = sink.load(records, units)
+    seconds = time.perf_counter() - start
+    metrics.record("load", seconds, len(records), section=section)
+    logging.info(
+        f"{sink.name}: {list(records.stn.cat.categories)} {records.date.min()} to {records.date.max()}: "
+        f"{inserted} rows inserted, {skipped} rows skipped in {seconds:.1f}s"
+    )
+    return inserted, skipped
+
+
+LEGEND_BLOCKS = {"Stationen": "stn", "Parameter": "param"}
+
+
+def column_slices(ruler, header):
+    """column slices of a fixed width block, taken from the ruler if it has a
+    segment per column, otherwise from the field starts of the header"""
+    if len(re.findall(r"-+", ruler)) > 1:
+        starts = [m.start() for m in re.finditer(r"-+", ruler)]
+    else:
+        starts = [m.start() for m in re.finditer(r"\S+(?: \S+)*", header)]
+    if len(starts) == 0 or starts[0] > 0:  # the parameter id has no header
+        starts.insert(0, 0)
+    return [slice(a, b) for a, b in zip(starts, starts[1:] + [None])]
+
+
+def read_legend_blocks(lines):
+    """split the station and parameter blocks of a legend into fields"""
+    blocks = {block: [] for block in LEGEND_BLOCKS.values()}
+    previous = ""
+    for line in lines:
+        title = previous.strip()
+        if line.startswith("---------") and title in LEGEND_BLOCKS:
+            slices = column_slices(line, next(lines, ""))
+            rows = blocks[LEGEND_BLOCKS[title]]
+            for row in lines:
+                if is_empty_line(row):
+                    break
+                rows.append([row[s].strip() for s in slices])
+            line = ""
+        previous = line
+    return blocks
 
 
 def parse_legend_file(archive, filename):
     print("reading input file:", filename)
     with archive.open(filename) as f:
-        file_content = TextIOWrapper(f).readlines()
+        blocks = read_legend_blocks(iter(TextIOWrapper(f)))
 
-    # extract stn and param part from file
-    current_block = None
-    stns = []
-    params = []
-    for i in range(2, len(file_content)):
-        if file_content[i - 1].startswith("---------"):
-            if file_content[i - 2].startswith("Parameter"):
-                current_block = "param"
-            elif file_content[i - 2].startswith("Stationen"):
-                current_block = "stn"
-        if len(file_content[i]) == 1:
-            current_block = None
-        if current_block == "stn":
-            stns.append(file_content[i])
-        elif current_block == "param":
-            params.append(file_content[i])
-
-    params[0] = "param_id  " + params[0]
-
-    # extract stations
-    stn_content = []
-    for i in range(1, len(stns)):
-        stn_content.append(
-            [
-                remove_newline(remove_whitespace(i))
-                for i in list(filter(None, stns[i].split("  ")))
-            ]
-        )
-    stn_ids = [s[0] for s in stn_content]
-    np.unique([s[1] for s in stn_content])
-    known_stn = []
-    unique_stns = []
-    for i in range(len(stn_content)):
-        if not stn_content[i][0] in known_stn:
-            known_stn.append(stn_content[i][0])
-            lat, lon = dms2latlon(stn_content[i][4])
-            unique_stns.append(
-                {
-                    "stn_id": stn_content[i][0],
-                    "stn_name": stn_content[i][1],
-                    "data_src": stn_content[i][3],
-                    "latitude": lat,
-                    "longitude": lon,
-                    "altitude": stn_content[i][6],
-                }
-            )
+    # stations are listed once per parameter
+    unique_stns = {}
+    for row in blocks["stn"]:
+        if row[0] not in unique_stns:
+            lat, lon = dms2latlon(row[4])
+            unique_stns[row[0]] = {
+                "stn_id": row[0],
+                "stn_name": row[1],
+                "data_src": row[3],
+                "latitude": lat,
+                "longitude": lon,
+                "altitude": row[6],
+            }
+    df_station = pd.DataFrame(
+        data=list(unique_stns.values()),
+        columns=["stn_id", "stn_name", "data_src", "latitude", "longitude", "altitude"],
+    )
+    df_station = df_station.astype({"latitude": "float64", "longitude": "float64"})
+    df_station["altitude"] = pd.to_numeric(
+        df_station["altitude"], errors="coerce"
+    ).astype("Int64")
 
-    df_station = pd.DataFrame(data=unique_stns)
-
-    # extract parameters
-    param_content = []
-    for i in range(1, len(params)):
-
-        param_content.append(
-            [
-                remove_newline(remove_whitespace(i))
-                for i in list(
-                    filter(
-                        None,
-                        [params[i].split(" ")[0]]
-                        + replace_semicolon(" ".join(params[i].split(" ")[1:])).split(
-                            "  "
-                        ),
-                    )
-                )
-            ]
-        )
-    unique_params = []
-    for i in range(len(param_content)):
-        unique_params.append(
+    df_param = pd.DataFrame(
+        data=[
             {
-                "param_id": param_content[i][0],
-                "unit": param_content[i][1],
-                "description": param_content[i][2],
+                "param_id": row[0],
+                "unit": replace_semicolon(row[1]),
+                "description": replace_semicolon(row[2]),
             }
-        )
-
-    df_param = pd.DataFrame(data=unique_params)
+            for row in blocks["param"]
+        ],
+        columns=["param_id", "unit", "description"],
+    )
     return df_station, df_param
 
 
-def parse_data_file(archive, filename):
+class SectionReader:
+    """file-like view on one section of a data file: returns lines of the
+    underlying stream until the next empty line"""
+
+    def __init__(self, stream, first_line):
+        self._stream = stream
+        self._pending = first_line
+        self._done = False
+
+    def readline(self, size=-1):
+        if self._pending is not None:
+            line, self._pending = self._pending, None
+            return line
+        if self._done:
+            return ""
+        line = self._stream.readline()
+        if is_empty_line(line):
+            self._done = True
+            return ""
+        return line
+
+    def read(self, size=-1):
+        lines = []
+        n = 0
+        while size is None or size < 0 or n < size:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            n += len(line)
+        return "".join(lines)
+
+    def readlines(self):
+        return list(self)
+
+    def drain(self):
+        while self.readline():
+            pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+def iter_data_sections(archive, filename):
+    """walks the data file line by line and yields one SectionReader per
+    section, the previous section is skipped if it was not read completely"""
     with archive.open(filename) as f:
-        file_content = TextIOWrapper(f).readlines()
-    section_ends = [-1]
-    while is_empty_line(file_content[0]):
-        file_content.pop(0)
-    for i in range(len(file_content)):
-        if is_empty_line(file_content[i]):
-            section_ends.append(i - 1)
-
-    sections = []
-    for i in range(len(section_ends) - 1):
-        clean_section = []
-        section_content = file_content[section_ends[i] + 1 : section_ends[i + 1]]
-        for j in range(len(section_content)):
-            if not is_empty_line(section_content[j]):
-                clean_section.append(section_content[j])
-        sections.append(clean_section)
-    return sections
+        stream = TextIOWrapper(f)
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            if is_empty_line(line):
+                continue
+            section = SectionReader(stream, line)
+            yield section
+            section.drain()
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", required=True)
-    parser.add_argument("-c", "--credentials", required=True)
-    args = parser.parse_args()
-    input_file = Path(args.input)
-    logging.info(input_file)
-    configuration = Path(args.credentials)
-    if not configuration.suffix in [".yaml", ".yml"]:
-        logging.error("invalid configuration!")
-        exit(1)
-    try:
-        archive = zipfile.ZipFile(input_file, "r")
-    except:
-        logging.error(f"Failed open {input_file} , Aborting.")
-        exit(1)
+def parse_data_file(archive, filename):
+    return [section.readlines() for section in iter_data_sections(archive, filename)]
+
+
+def iter_text_chunks(section, chunksize, max_bytes=None):
+    """yields the section as csv text of at most chunksize rows and, if given,
+    about max_bytes characters, every chunk starts with the section header"""
+    header = section.readline()
+    lines = []
+    size = 0
+    for line in section:
+        lines.append(line)
+        size += len(line)
+        if len(lines) == chunksize or (max_bytes is not None and size >= max_bytes):
+            yield header + "".join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield header + "".join(lines)
+
+
+def chunk_rows(text):
+    """data rows of a chunk from iter_text_chunks"""
+    return text.count("\n") - text.endswith("\n")
+
+
+def chunk_params(text):
+    return text[: text.index("\n")].strip().split(";")[2:]
+
+
+def archive_digest(path):
+    """sha256 of an archive file, the manifest key of its units"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def committed_ranges(units):
+    """(data_file, section, param_id) -> merged [first_row, last_row) ranges of
+    committed manifest units"""
+    ranges = {}
+    for data_file, section, param_id, first_row, last_row in sorted(
+        units, key=lambda unit: unit[3]
+    ):
+        merged = ranges.setdefault((data_file, section, param_id), [])
+        if merged and first_row <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], last_row)
+        else:
+            merged.append([first_row, last_row])
+    return ranges
+
+
+def is_committed(ranges, first_row, last_row):
+    return any(a <= first_row and last_row <= b for a, b in ranges)
+
+
+def find_archives(inputs):
+    archives = []
+    for input_path in map(Path, inputs):
+        if input_path.is_dir():
+            archives += sorted(input_path.glob("*.zip"))
+        else:
+            archives.append(input_path)
+    return archives
+
+
+def open_archive(input_file):
+    archive = zipfile.ZipFile(input_file, "r")
     files_in_zip = archive.namelist()
     data_files = list(filter(lambda k: "_data" in k, files_in_zip))
     legend_files = list(filter(lambda k: "_legend" in k, files_in_zip))
-    logging.info(f"found {len(legend_files)} legend files.")
-    logging.info(f"found {len(data_files)} data files.")
-    assert len(legend_files) == 1
-    assert len(data_files) == 1
-    conn = postgresql_connect(configuration)
-    df_station, df_param = parse_legend_file(archive, legend_files[0])
     logging.info(
-        f"{len(df_station)} Stations, {len(df_param)} parameters in {legend_files[0]}"
+        f"{input_file}: found {len(legend_files)} legend files, {len(data_files)} data files."
     )
-    # insert stations
-    logging.info("Inserting Stations")
-    insert_stations(df_station, conn)
-    # insert parameters
-    logging.info("Inserting Parameters")
-    insert_parameters(df_param, conn)
-    data_sections = parse_data_file(archive, data_files[0])
-    data_section_sio = [StringIO("".join(s)) for s in data_sections]
-    for section in data_section_sio:
-        df = csvStringIO_to_df(section)
+    return archive, legend_files, data_files
+
+
+def insert_legends(archives, sink):
+    """stations and parameters of all archives, synchronised before any data
+    is loaded, returns the station and parameter ids"""
+    stations = []
+    params = []
+    for input_file in archives:
+        archive, legend_files, _ = open_archive(input_file)
+        for legend_file in legend_files:
+            with metrics.timer("legend"):
+                df_station, df_param = parse_legend_file(archive, legend_file)
+            logging.info(
+                f"{len(df_station)} Stations, {len(df_param)} parameters in {legend_file}"
+            )
+            stations.append(df_station)
+            params.append(df_param)
+    if len(stations) == 0:
+        return set(), set()
+    df_station = pd.concat(stations, ignore_index=True)
+    df_param = pd.concat(params, ignore_index=True)
+    logging.info("Synchronising Stations and Parameters")
+    with metrics.timer("metadata", len(df_station) + len(df_param)):
+        sink.sync_metadata(df_station, df_param)
+    return set(df_station["stn_id"]), set(df_param["param_id"])
+
+
+# memory held per character of csv text while a chunk is parsed and loaded
+CHUNK_MEMORY_FACTOR = 10
+
+
+def chunks_in_flight(workers, load_workers):
+    """upper bound of chunks held by ingest_data at the same time"""
+    return 2 * workers + 2 * load_workers + 3
+
+
+def ingest_data(
+    archives,
+    sink,
+    workers,
+    load_workers,
+    chunksize,
+    watermarks=None,
+    dtypes=None,
+    csv_engine="typed",
+    memory_budget=None,
+    resume=False,
+):
+    """parse section chunks in a process pool and load them into the sink from
+    a thread pool, the number of chunks in flight is bounded by the pool sizes.
+    With a memory_budget (bytes) the chunks are cut small enough for all chunks
+    in flight to fit into it, independent of the section length.
+    Every (section, parameter, row range) unit is committed together with its
+    manifest entry, with resume the units committed by earlier runs of the same
+    archive are skipped.
+    With watermarks the chunks are loaded one at a time in their order and not
+    after a failed one, so the rows before the latest stored row of a station
+    and parameter are complete for the next incremental run. Archives with
+    units committed by earlier runs are not pruned, an interrupted run may have
+    committed later chunks before earlier ones.
+    Returns the number of inserted, skipped and pruned rows and resumed units"""
+    ordered = watermarks is not None
+    if ordered:
+        load_workers = 1
+    max_bytes = None
+    if memory_budget is not None:
+        max_bytes = memory_budget // (
+            chunks_in_flight(workers, load_workers) * CHUNK_MEMORY_FACTOR
+        )
         logging.info(
-            f"Inserting Data {df.stn.unique()}: {df.date.min()} to {df.date.max()}"
+            f"memory budget {memory_budget >> 20} MB: chunks of {max_bytes >> 10} kB csv"
         )
-        insert_data(df, conn)
+    totals = dict(inserted=0, skipped=0, pruned=0, resumed=0)
+    parsed = deque()
+    loads = deque()
+
+    def collect(limit):
+        while len(loads) > limit:
+            inserted, skipped = loads.popleft().result()
+            totals["inserted"] += inserted
+            totals["skipped"] += skipped
+
+    def load_in_order(previous, *args):
+        if previous is not None and previous.exception() is not None:
+            raise RuntimeError("not loaded after a failed chunk")
+        return load_chunk(*args)
+
+    def dispatch(limit):
+        while len(parsed) > limit:
+            section, units, future = parsed.popleft()
+            records, pruned, timings = future.result()
+            for stage, seconds, rows, size in timings:
+                metrics.record(stage, seconds, rows, size, section)
+            totals["pruned"] += pruned
+            params = [unit[3] for unit in units]
+            if not records["param"].isin(params).all():
+                records = records[records["param"].isin(params)].reset_index(drop=True)
+            if ordered:
+                previous = loads[-1] if loads else None
+                load = load_pool.submit(
+                    load_in_order, previous, records, sink, section, units
+                )
+            else:
+                load = load_pool.submit(load_chunk, records, sink, section, units)
+            loads.append(load)
+            collect(2 * load_workers)
+
+    digests = {input_file: archive_digest(input_file) for input_file in archives}
+    # the manifest is read before any load starts, while loads are running
+    # all connections of the pool may be taken
+    committed_by_archive = {}
+    if resume or ordered:
+        for input_file, archive_sha256 in digests.items():
+            committed = committed_ranges(sink.committed_units(archive_sha256))
+            committed_by_archive[input_file] = committed
+            if resume:
+                logging.info(
+                    f"{input_file}: resuming after {len(committed)} committed section parameters"
+                )
+
+    with ProcessPoolExecutor(
+        workers,
+        initializer=init_parse_worker,
+        initargs=(watermarks or {}, dtypes, csv_engine),
+    ) as parse_pool, ThreadPoolExecutor(load_workers) as load_pool:
+        for input_file in archives:
+            archive, _, data_files = open_archive(input_file)
+            archive_sha256 = digests[input_file]
+            committed = committed_by_archive.get(input_file, {})
+            prune = not committed
+            if ordered and not prune:
+                logging.info(f"{input_file}: not pruned, loaded by an earlier run")
+            if not resume:
+                committed = {}
+            for data_file in data_files:
+                sections = iter_data_sections(archive, data_file)
+                for i, section in enumerate(sections):
+                    section_key = f"{Path(input_file).name}:{data_file}:{i}"
+                    chunks = metrics.timed_iter(
+                        iter_text_chunks(section, chunksize, max_bytes),
+                        "split",
+                        section_key,
+                        rows=chunk_rows,
+                        size=len,
+                    )
+                    first_row = 0
+                    for text in chunks:
+                        last_row = first_row + chunk_rows(text)
+                        units = []
+                        for param_id in chunk_params(text):
+                            ranges = committed.get((data_file, i, param_id), [])
+                            if is_committed(ranges, first_row, last_row):
+                                totals["resumed"] += 1
+                            else:
+                                units.append(
+                                    (archive_sha256, data_file, i, param_id, first_row, last_row)
+                                )
+                        first_row = last_row
+                        if not units:
+                            continue
+                        parsed.append(
+                            (
+                                section_key,
+                                units,
+                                parse_pool.submit(parse_chunk, text, prune),
+                            )
+                        )
+                        dispatch(2 * workers)
+        dispatch(0)
+        collect(0)
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i", "--input", required=True, nargs="+", help="zip files or directories"
+    )
+    parser.add_argument("-c", "--credentials")
+    parser.add_argument(
+        "--parquet",
+        help="write to a partitioned Parquet dataset in this directory instead of PostgreSQL",
+    )
+    parser.add_argument("--loader", choices=LOADERS.keys(), default="copy")
+    parser.add_argument("--chunksize", type=int, default=200000)
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        help="memory in MB for the chunks in flight, limits the chunk size in addition to --chunksize",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--db-connections",
+        type=int,
+        default=4,
+        help="database connections, or Parquet writer threads with --parquet",
+    )
+    parser.add_argument("--csv-engine", choices=CSV_ENGINES, default="typed")
+    parser.add_argument(
+        "--metrics",
+        help="write stage metrics to this file, Prometheus textfile if it ends with .prom, JSON otherwise",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only load rows newer than the latest stored row per station and parameter, the chunks are loaded one at a time in order",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the units of the archives committed by an earlier run",
+    )
+    args = parser.parse_args()
+    archives = find_archives(args.input)
+    logging.info(f"{len(archives)} archives: {[str(a) for a in archives]}")
+    for input_file in archives:
+        try:
+            zipfile.ZipFile(input_file, "r").close()
+        except:
+            logging.error(f"Failed open {input_file} , Aborting.")
+            exit(1)
+    if args.parquet:
+        from parquet_sink import ParquetSink
+
+        sink = ParquetSink(args.parquet)
+    else:
+        if args.credentials is None:
+            logging.error("credentials (-c) or --parquet required!")
+            exit(1)
+        configuration = Path(args.credentials)
+        if not configuration.suffix in [".yaml", ".yml"]:
+            logging.error("invalid configuration!")
+            exit(1)
+        sink = DatabaseSink(
+            postgresql_pool(configuration, args.db_connections), args.loader
+        )
+    station_ids, param_ids = insert_legends(archives, sink)
+    watermarks = None
+    if args.incremental:
+        watermarks = sink.watermarks(station_ids)
+        logging.info(f"{len(watermarks)} station/parameter watermarks")
+    totals = ingest_data(
+        archives,
+        sink,
+        args.workers,
+        args.db_connections,
+        args.chunksize,
+        watermarks,
+        section_dtypes(param_ids),
+        args.csv_engine,
+        args.memory_budget << 20 if args.memory_budget else None,
+        args.resume,
+    )
+    sink.close()
+    if args.metrics:
+        metrics.write(args.metrics)
+        logging.info(f"metrics written to {args.metrics}")
+    logging.info(
+        f"Done: {totals['inserted']} rows inserted, {totals['skipped']} rows skipped, "
+        f"{totals['pruned']} rows pruned before loading, "
+        f"{totals['resumed']} committed units resumed"
+    )
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SCHEMA = pa.schema(
+    [
+        ("date", pa.timestamp("us")),
+        ("param", pa.dictionary(pa.int16(), pa.string())),
+        ("value", pa.float32()),
+    ]
+)
+PARTITIONING = ds.partitioning(
+    pa.schema([("stn", pa.string()), ("year", pa.int32())]), flavor="hive"
+)
+
+
+def write_table_atomic(table, path, **kwargs):
+    """files starting with '.' are ignored by dataset discovery"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    pq.write_table(table, tmp_path, **kwargs)
+    os.replace(tmp_path, path)
+
+
+class ParquetSink:
+    """writes long format records to a Parquet dataset partitioned by station
+    and year (root/stn=<id>/year=<yyyy>/data.parquet). A partition is merged
+    with the rows it already holds, duplicates of stored rows are skipped"""
+
+    name = "parquet"
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.partition_locks = defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def partition_path(self, stn_id, year):
+        return self.root / f"stn={stn_id}" / f"year={year}" / "data.parquet"
+
+    def load(self, records, units=None):
+        """returns (inserted, skipped). The manifest units are appended to
+        _manifest.jsonl once all partitions are written, a run stopped in
+        between reloads the units and the partition merge drops the duplicates"""
+        inserted = 0
+        years = records["date"].dt.year.rename("year")
+        for (stn_id, year), rows in records.groupby(
+            [records["stn"], years], observed=True
+        ):
+            with self.lock:
+                partition_lock = self.partition_locks[(stn_id, year)]
+            with partition_lock:
+                inserted += self.merge_partition(
+                    self.partition_path(stn_id, year), rows
+                )
+        if units:
+            with self.lock, open(self.root / "_manifest.jsonl", "a") as f:
+                f.writelines(json.dumps(unit) + "\n" for unit in units)
+                f.flush()
+                os.fsync(f.fileno())
+        return inserted, len(records) - inserted
+
+    def committed_units(self, archive_sha256):
+        path = self.root / "_manifest.jsonl"
+        if not path.exists():
+            return []
+        with open(path) as f:
+            units = [json.loads(line) for line in f if line.endswith("\n")]
+        return [tuple(unit[1:]) for unit in units if unit[0] == archive_sha256]
+
+    def merge_partition(self, path, rows):
+        rows = rows[["date", "param", "value"]].astype({"param": str})
+        n_stored = 0
+        if path.exists():
+            stored = pq.read_table(path, memory_map=True).to_pandas()
+            n_stored = len(stored)
+            rows = pd.concat([stored.astype({"param": str}), rows], ignore_index=True)
+        rows = rows.drop_duplicates(["date", "param"], keep="first")
+        rows = rows.sort_values(["param", "date"]).astype({"param": "category"})
+        table = pa.Table.from_pandas(rows, schema=SCHEMA, preserve_index=False)
+        write_table_atomic(table, path, compression="zstd")
+        return len(rows) - n_stored
+
+    def sync_metadata(self, df_station, df_param):
+        """stations and parameters are kept in _stations.parquet and
+        _parameters.parquet next to the partitions, newer rows replace stored ones"""
+        for df, key, name in [
+            (df_station, "stn_id", "_stations.parquet"),
+            (df_param, "param_id", "_parameters.parquet"),
+        ]:
+            path = self.root / name
+            if path.exists():
+                df = pd.concat([pq.read_table(path).to_pandas(), df], ignore_index=True)
+            df = df.drop_duplicates(key, keep="last").reset_index(drop=True)
+            write_table_atomic(pa.Table.from_pandas(df, preserve_index=False), path)
+            logging.info(f"{len(df)} rows in {path}")
+
+    def watermarks(self, station_ids):
+        """latest stored timestamp per (station, param) of the given stations"""
+        if not any(self.root.glob("stn=*")):
+            return {}
+        df = read_dataset(self.root, stations=station_ids, columns=["stn", "param", "date"])
+        latest = df.groupby(["stn", "param"], observed=True)["date"].max()
+        return {
+            (stn_id, param_id): np.datetime64(max_ts, "us")
+            for (stn_id, param_id), max_ts in latest.items()
+        }
+
+    def close(self):
+        pass
+
+
+def read_dataset(root, params=None, stations=None, start=None, end=None, columns=None):
+    """read a dataset written by ParquetSink. The files are memory-mapped,
+    station and year filters prune partitions, parameter and time filters are
+    pushed down to the row groups. end is inclusive"""
+    filters = []
+    if stations is not None:
+        filters.append(("stn", "in", list(stations)))
+    if params is not None:
+        filters.append(("param", "in", list(params)))
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters += [("year", ">=", start.year), ("date", ">=", start)]
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters += [("year", "<=", end.year), ("date", "<=", end)]
+    table = pq.read_table(
+        root,
+        columns=columns,
+        filters=filters or None,
+        partitioning=PARTITIONING,
+        memory_map=True,
+    )
+    return table.to_pandas()
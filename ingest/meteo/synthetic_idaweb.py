@@ -0,0 +1,170 @@
+import argparse
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+RESOLUTIONS = {"daily": "D", "hourly": "h", "10min": "10min"}
+PARAM_SUFFIXES = {"daily": "d0", "hourly": "h0", "10min": "z0"}
+PARAM_BASES = [
+    ("tre200", "°C", "Lufttemperatur 2 m über Boden"),
+    ("rre150", "mm", "Niederschlag"),
+    ("ure200", "%", "Relative Luftfeuchtigkeit 2 m über Boden"),
+    ("prestas", "hPa", "Luftdruck auf Stationshöhe (QFE)"),
+    ("fkl010", "m/s", "Windgeschwindigkeit skalar"),
+    ("dkl010", "°", "Windrichtung"),
+    ("gre000", "W/m²", "Globalstrahlung"),
+    ("sre000", "min", "Sonnenscheindauer"),
+    ("tde200", "°C", "Taupunkt 2 m über Boden"),
+    ("hto000", "cm", "Gesamtschneehöhe"),
+]
+AGGREGATIONS = {"daily": "Tagesmittel", "hourly": "Stundenmittel", "10min": "Zehnminutenmittel"}
+
+
+def encode_time(date, freq):
+    """yyyymmdd[HH[MM]] integers as written by IDAWEB"""
+    time = (
+        date.dt.year.astype(np.int64) * 10**4 + date.dt.month * 10**2 + date.dt.day
+    )
+    if freq != "D":
+        time = time * 10**2 + date.dt.hour
+    if freq == "10min":
+        time = time * 10**2 + date.dt.minute
+    return time
+
+
+def synthetic_section(
+    n_rows, n_params, nan_ratio=0.05, seed=0, freq="10min", n_stations=1
+):
+    """wide section frame as returned by csvStringIO_to_df, the rows are
+    split over n_stations stations"""
+    rng = np.random.default_rng(seed)
+    per_station = n_rows // n_stations
+    date = pd.Series(
+        np.tile(pd.date_range("1990-01-01", periods=per_station, freq=freq), n_stations)
+    )
+    df = pd.DataFrame(
+        {
+            "stn": np.repeat([f"S{i:03d}" for i in range(n_stations)], per_station),
+            "time": encode_time(date, freq),
+            "date": date,
+        }
+    )
+    n_rows = len(df)
+    for i in range(n_params):
+        values = rng.normal(size=n_rows).astype(np.float32)
+        values[rng.random(n_rows) < nan_ratio] = np.nan
+        df[f"param{i:02d}"] = values
+    return df
+
+
+def section_text(df):
+    """csv text of a section like in an IDAWEB data file"""
+    return df.drop(columns="date").to_csv(
+        sep=";", index=False, na_rep="-", float_format="%.1f"
+    )
+
+
+def parameters(n_params, resolution):
+    """(param_id, unit, description) of n_params parameters"""
+    params = []
+    for i in range(n_params):
+        base, unit, description = PARAM_BASES[i % len(PARAM_BASES)]
+        if i >= len(PARAM_BASES):
+            base = f"{base[:4]}{i:03d}"
+        description = f"{description}; {AGGREGATIONS[resolution]}"
+        params.append((base + PARAM_SUFFIXES[resolution], unit, description))
+    return params
+
+
+def stations(n_stations, seed=0):
+    """(stn_id, name, lon/lat, km coordinates, altitude) of n_stations stations"""
+    rng = np.random.default_rng(seed)
+    stns = []
+    for i in range(n_stations):
+        lon = (6, int(rng.integers(0, 60)))
+        lat = (46, int(rng.integers(0, 60)))
+        stns.append(
+            (
+                f"S{i:03d}",
+                f"Station {i:03d} / Ort  {i % 7}",
+                f"{lon[0]}°{lon[1]}'/{lat[0]}°{lat[1]}'",
+                f"{2600000 + i * 1000}/{1200000 + i * 1000}",
+                int(rng.integers(200, 3500)),
+            )
+        )
+    return stns
+
+
+def legend_text(stns, params):
+    lines = ["Stationen", "---------"]
+    lines.append(
+        f"{'stn':10}{'Name':37}{'Parameter':11}{'Datenquelle':60}"
+        f"{'Längen-/Breitengrad':21}{'KM-Koordinaten':18}Höhe ü. M."
+    )
+    for param_id, _, _ in params:
+        for stn_id, name, lonlat, km, altitude in stns:
+            lines.append(
+                f"{stn_id:10}{name:37}{param_id:11}{'MeteoSchweiz':60}"
+                f"{lonlat:21}{km:18}{altitude}"
+            )
+    lines += ["", "Parameter", "---------", f"{'':14}{'Einheit':21}Beschreibung"]
+    for param_id, unit, description in params:
+        lines.append(f"{param_id:14}{unit:21}{description}")
+    lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def write_archive(
+    path,
+    n_stations=2,
+    n_params=3,
+    resolution="hourly",
+    start="2020-01-01",
+    end="2020-12-31",
+    nan_ratio=0.05,
+    seed=0,
+):
+    """write an IDAWEB like zip with a legend and a data file holding one
+    section per station"""
+    freq = RESOLUTIONS[resolution]
+    stns = stations(n_stations, seed)
+    params = parameters(n_params, resolution)
+    date = pd.Series(pd.date_range(start, end, freq=freq))
+    time = encode_time(date, freq)
+    rng = np.random.default_rng(seed)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("order_0_legend.txt", legend_text(stns, params))
+        with archive.open("order_0_data.txt", "w") as f:
+            for stn_id, _, _, _, _ in stns:
+                df = pd.DataFrame({"stn": stn_id, "time": time})
+                for param_id, _, _ in params:
+                    values = np.round(rng.normal(10, 8, size=len(date)), 1)
+                    values[rng.random(len(date)) < nan_ratio] = np.nan
+                    df[param_id] = values
+                f.write(b"\n")
+                f.write(df.to_csv(sep=";", index=False, na_rep="-").encode())
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--stations", type=int, default=2)
+    parser.add_argument("--params", type=int, default=3)
+    parser.add_argument("--resolution", choices=RESOLUTIONS.keys(), default="hourly")
+    parser.add_argument("--start", default="2020-01-01")
+    parser.add_argument("--end", default="2020-12-31")
+    parser.add_argument("--nan-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_archive(
+        args.output,
+        n_stations=args.stations,
+        n_params=args.params,
+        resolution=args.resolution,
+        start=args.start,
+        end=args.end,
+        nan_ratio=args.nan_ratio,
+        seed=args.seed,
+    )
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the ingest scripts are imported as top level modules, like when they are run
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,126 @@
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from insert_from_zip import parse_legend_file, read_legend_blocks
+from synthetic_idaweb import legend_text, parameters, stations
+
+LEGENDS = Path(__file__).with_name("legends")
+
+
+def read_blocks(name):
+    with open(LEGENDS / name, encoding="utf-8") as f:
+        return read_legend_blocks(iter(f))
+
+
+def parse_legend(tmp_path, name):
+    path = tmp_path / "order.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.write(LEGENDS / name, name)
+    with zipfile.ZipFile(path) as archive:
+        return parse_legend_file(archive, name)
+
+
+def test_station_block_fields():
+    blocks = read_blocks("order_daily_legend.txt")
+    # one row per station and parameter, the header is not a row
+    assert len(blocks["stn"]) == 12
+    assert blocks["stn"][0] == [
+        "BAS",
+        "Basel / Binningen",
+        "tre200d0",
+        "MeteoSchweiz",
+        "7°35'/47°32'",
+        "2610911/1265600",
+        "316",
+    ]
+
+
+def test_names_with_double_spaces():
+    blocks = read_blocks("order_daily_legend.txt")
+    assert "St. Gallen  Nord" in [row[1] for row in blocks["stn"]]
+    blocks = read_blocks("order_10min_legend.txt")
+    assert [row[1] for row in blocks["stn"][:3]] == [
+        "Basel / Binningen",
+        "Zürich  /  Kloten",
+        "Col du Grand St-Bernard",
+    ]
+    assert [row[4] for row in blocks["stn"][:2]] == [
+        "7°35'0''/47°32'28''",
+        "8°32'11''/47°28'48''",
+    ]
+
+
+def test_parameter_header_without_id_column():
+    blocks = read_blocks("order_daily_legend.txt")
+    assert blocks["param"] == [
+        ["tre200d0", "°C", "Lufttemperatur 2 m über Boden; Tagesmittel"],
+        ["rre150d0", "mm", "Niederschlag; Tagessumme 6 UTC - 6 UTC Folgetag"],
+        ["sre000d0", "min", "Sonnenscheindauer; Tagessumme"],
+    ]
+    blocks = read_blocks("order_10min_legend.txt")
+    assert [row[:2] for row in blocks["param"]] == [["tre200s0", "°C"], ["ure200s0", "%"]]
+
+
+def test_blocks_after_the_parameters_are_ignored():
+    blocks = read_blocks("order_daily_legend.txt")
+    assert all(len(row) == 3 for row in blocks["param"])
+    assert "Zeitstempel" not in [row[0] for row in blocks["param"]]
+
+
+def test_duplicate_stations(tmp_path):
+    df_station, df_param = parse_legend(tmp_path, "order_daily_legend.txt")
+    # every station is listed once per parameter
+    assert df_station["stn_id"].tolist() == ["BAS", "SMA", "STG", "JUN"]
+    assert df_station["stn_name"].tolist() == [
+        "Basel / Binningen",
+        "Zürich / Fluntern",
+        "St. Gallen  Nord",
+        "Jungfraujoch",
+    ]
+    assert df_param["param_id"].tolist() == ["tre200d0", "rre150d0", "sre000d0"]
+
+
+@pytest.mark.parametrize("name", ["order_daily_legend.txt", "order_10min_legend.txt"])
+def test_dtypes(tmp_path, name):
+    df_station, df_param = parse_legend(tmp_path, name)
+    assert list(df_station.columns) == [
+        "stn_id",
+        "stn_name",
+        "data_src",
+        "latitude",
+        "longitude",
+        "altitude",
+    ]
+    assert df_station["latitude"].dtype == "float64"
+    assert df_station["longitude"].dtype == "float64"
+    assert df_station["altitude"].dtype == "Int64"
+    assert list(df_param.columns) == ["param_id", "unit", "description"]
+
+
+def test_station_values(tmp_path):
+    df_station, _ = parse_legend(tmp_path, "order_10min_legend.txt")
+    bas = df_station.set_index("stn_id").loc["BAS"]
+    assert bas["latitude"] == pytest.approx(47 + 32 / 60 + 28 / 3600)
+    assert bas["longitude"] == pytest.approx(7 + 35 / 60)
+    assert bas["altitude"] == 316
+    assert bas["data_src"] == "MeteoSchweiz"
+    # altitude "-" is missing, not an error
+    assert df_station.set_index("stn_id").loc["GSB", "altitude"] is pd.NA
+
+
+def test_parameter_descriptions(tmp_path):
+    _, df_param = parse_legend(tmp_path, "order_daily_legend.txt")
+    assert df_param["unit"].tolist() == ["°C", "mm", "min"]
+    assert df_param["description"].tolist()[0] == "Lufttemperatur 2 m über Boden:Tagesmittel"
+
+
+def test_synthetic_legend():
+    stns = stations(50, seed=1)
+    params = parameters(4, "10min")
+    blocks = read_legend_blocks(iter(legend_text(stns, params).splitlines(True)))
+    assert len(blocks["stn"]) == 50 * 4
+    assert [row[1] for row in blocks["stn"][:50]] == [stn[1] for stn in stns]
+    assert [row[0] for row in blocks["param"]] == [param[0] for param in params]
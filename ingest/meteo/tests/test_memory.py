@@ -0,0 +1,18 @@
+from argparse import Namespace
+
+from benchmark import memory_runs, within_memory_budget
+
+
+def test_peak_memory_does_not_grow_with_section_length():
+    # a section four times as long has to fit into the same small budget
+    args = Namespace(
+        memory_budget=32,
+        years=[1, 4],
+        params=3,
+        workers=1,
+        load_workers=1,
+        chunksize=10**9,
+    )
+    runs = memory_runs(args)
+    assert runs[1]["rows"] > 3 * runs[0]["rows"]
+    assert within_memory_budget(runs, args.memory_budget)
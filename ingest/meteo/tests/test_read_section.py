@@ -0,0 +1,26 @@
+from io import StringIO
+
+import numpy as np
+import pytest
+
+from insert_from_zip import (
+    CSV_ENGINES,
+    csvStringIO_to_df,
+    read_section_typed,
+    section_dtypes,
+)
+
+SECTION = "stn;time;p1;p2\nBAS;20200101;1.5;-\nBAS;20200102;x;2\n"
+
+
+@pytest.mark.parametrize("engine", [e for e in CSV_ENGINES if e != "pandas"])
+def test_non_numeric_values_are_nan(engine):
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    df = read_section_typed(StringIO(SECTION), section_dtypes(["p1", "p2"]), engine)
+    expected = csvStringIO_to_df(StringIO(SECTION))
+    assert df.columns.tolist() == ["stn", "time", "date", "p1", "p2"]
+    assert (df["date"] == expected["date"]).all()
+    for col in ["p1", "p2"]:
+        assert df[col].dtype == np.float32
+        np.testing.assert_array_equal(df[col], expected[col])